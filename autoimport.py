@@ -3,23 +3,35 @@
 packages contained. It has rather strong assumptions on the working directory.
 """
 
+import binascii
+import contextlib
 import gzip
 import io
+import itertools
 import multiprocessing
 import optparse
 import os
+import Queue
+import shutil
+import signal
 import sqlite3
 import subprocess
+import threading
 import urllib
 
 import concurrent.futures
 from debian import deb822
 from debian.debian_support import version_compare
 
-from readyaml import readyaml
+from dedup.binformat import dump_records, load_records
+from dedup.download import DownloadInterrupted, Downloader
+from dedup.hashcache import DerivedHashCache
+from dedup.utils import fetchiter
+from importpkg import process_package, process_package_with_hash
+from readyaml import import_package, insert_package
 
 def process_http(pkgs, url):
-    pkglist = urllib.urlopen(url + "/dists/sid/main/binary-amd64/Packages.gz").read()
+    pkglist = Downloader().open(url + "/dists/sid/main/binary-amd64/Packages.gz").read()
     pkglist = gzip.GzipFile(fileobj=io.BytesIO(pkglist)).read()
     pkglist = io.BytesIO(pkglist)
     pkglist = deb822.Packages.iter_paragraphs(pkglist)
@@ -52,41 +64,307 @@ def process_dir(pkgs, d):
         except ValueError:
             pass
 
-def process_pkg(name, pkgdict):
+def payload_key(metadata):
+    return (metadata["package"], metadata["version"],
+            metadata["architecture"], metadata["datasize"],
+            metadata["datamtime"])
+
+def is_known_payload(filename, knownpayloads):
+    """Check whether a local .deb file was imported before by reading only
+    its ar headers and control information.
+    @type knownpayloads: set
+    @param knownpayloads: payload_key tuples of the imported packages
+    """
+    with open(filename, "rb") as inp:
+        gen = process_package(inp)
+        try:
+            # The metadata is generated before data.tar is decompressed.
+            return payload_key(next(gen)) in knownpayloads
+        except (ValueError, StopIteration):
+            return False
+        finally:
+            gen.close()
+
+thread_state = threading.local()
+
+def thread_downloader(ratelimit=None, slots=None):
+    """
+    @returns: a Downloader for the calling thread
+    """
+    try:
+        return thread_state.downloader
+    except AttributeError:
+        thread_state.downloader = Downloader(ratelimit, slots)
+        return thread_state.downloader
+
+def process_pkg(name, pkgdict, cachefile=None, ratelimit=None, slots=None):
+    """Import a package by running importpkg.py on it.
+    @param ratelimit: passed to thread_downloader
+    @param slots: passed to thread_downloader
+    """
     filename = pkgdict["filename"]
     print("importing %s" % filename)
-    importcmd = ["python", "importpkg.py"]
+    importcmd = ["python", "importpkg.py", "-f", "binary"]
     if "sha256hash" in pkgdict:
         importcmd.extend(["-H", pkgdict["sha256hash"]])
+    if cachefile:
+        importcmd.extend(["-c", cachefile])
     if filename.startswith("http://"):
-        with open(os.path.join("tmp", name), "w") as outp:
-            dl = subprocess.Popen(["curl", "-s", filename],
-                                  stdout=subprocess.PIPE, close_fds=True)
-            imp = subprocess.Popen(importcmd, stdin=dl.stdout, stdout=outp,
-                                   close_fds=True)
-            if imp.wait():
+        with open(os.path.join("tmp", name), "wb") as outp:
+            imp = subprocess.Popen(importcmd, stdin=subprocess.PIPE,
+                                   stdout=outp, close_fds=True)
+            try:
+                inp = thread_downloader(ratelimit, slots).open(filename)
+                try:
+                    shutil.copyfileobj(inp, imp.stdin)
+                finally:
+                    inp.close()
+            finally:
+                imp.stdin.close()
+                returncode = imp.wait()
+            if returncode:
                 raise ValueError("importpkg failed")
-            if dl.wait():
-                raise ValueError("curl failed")
     else:
-        with open(filename) as inp:
-            with open(os.path.join("tmp", name), "w") as outp:
+        importcmd.append("-m")
+        with open(filename, "rb") as inp:
+            with open(os.path.join("tmp", name), "wb") as outp:
                 subprocess.check_call(importcmd, stdin=inp, stdout=outp,
                                       close_fds=True)
     print("preprocessed %s" % name)
 
+def process_stream(inp, pkgdict, cache=None, usemmap=False):
+    """
+    @returns: the records of the package in binary format
+    """
+    if "sha256hash" in pkgdict:
+        gen = process_package_with_hash(inp, pkgdict["sha256hash"], cache)
+    else:
+        gen = process_package(inp, cache, usemmap=usemmap)
+    outp = io.BytesIO()
+    dump_records(gen, outp)
+    return outp.getvalue()
+
+def process_pkg_inprocess(pkgdict, cache=None, downloader=None):
+    """Import a package without spawning a python interpreter. Downloads
+    interrupted while parsing are restarted up to downloader.retries times.
+    @type cache: DerivedHashCache or None
+    @type downloader: Downloader or None
+    @param downloader: required for http urls
+    @returns: the records of the package in binary format
+    """
+    filename = pkgdict["filename"]
+    if not filename.startswith("http://"):
+        with open(filename, "rb") as inp:
+            return process_stream(inp, pkgdict, cache, usemmap=True)
+    for attempt in itertools.count():
+        inp = None
+        try:
+            # A timeout between acquiring a download slot and returning the
+            # stream that releases it would leak the slot.
+            with deferred_timeout():
+                inp = downloader.open(filename)
+            records = process_stream(inp, pkgdict, cache)
+            # complete the body, so the connection can be reused
+            while inp.read(65536):
+                pass
+            return records
+        except DownloadInterrupted:
+            if attempt >= downloader.retries:
+                raise
+            print("retrying %s" % filename)
+        finally:
+            if inp is not None:
+                inp.close()
+
+class PackageWriter(threading.Thread):
+    """Insert the packages passed to put into the database on a separate
+    thread. Many packages are grouped into one transaction with each package
+    in a savepoint of its own, so a failing package does not affect the
+    others. After each package, the done semaphore is released."""
+    batchsize = 100
+
+    def __init__(self, dbname, done, batchsize=None):
+        """
+        @type dbname: str
+        @param done: a semaphore
+        @type batchsize: int or None
+        @param batchsize: maximum number of packages per transaction
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.dbname = dbname
+        self.done = done
+        if batchsize is not None:
+            self.batchsize = batchsize
+        self.queue = Queue.Queue()
+        self.error = None
+
+    def put(self, name, records, sha256hash=None):
+        """
+        @type records: bytes
+        @param records: binary records as returned by process_pkg_inprocess
+        """
+        self.queue.put((name, records, sha256hash))
+
+    def finish(self):
+        """Wait for all packages to be committed.
+        @raises Exception: any error that stopped the writer
+        """
+        self.queue.put(None)
+        self.join()
+        if self.error:
+            raise self.error
+
+    def run(self):
+        # transactions are managed explicitly to make savepoints work
+        db = sqlite3.connect(self.dbname, isolation_level=None)
+        cur = db.cursor()
+        cur.execute("PRAGMA foreign_keys = ON;")
+        pending = 0
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            name, records, sha256hash = item
+            if self.error:
+                self.done.release()
+                continue
+            try:
+                if not pending:
+                    cur.execute("BEGIN;")
+                print("sqlimporting %s" % name)
+                cur.execute("SAVEPOINT package;")
+                try:
+                    insert_package(cur, load_records(io.BytesIO(records)),
+                                   sha256hash)
+                except Exception as exc:
+                    print("%s failed sql with exception %r" % (name, exc))
+                    cur.execute("ROLLBACK TO package;")
+                cur.execute("RELEASE package;")
+                pending += 1
+                # Commit early when the writer is idle, so results become
+                # visible whenever SQLite is not the bottleneck.
+                if pending >= self.batchsize or self.queue.empty():
+                    cur.execute("COMMIT;")
+                    pending = 0
+            except Exception as exc:
+                # keep consuming, so that producers waiting on done proceed
+                self.error = exc
+            self.done.release()
+        if pending and not self.error:
+            cur.execute("COMMIT;")
+        db.close()
+
+class TaskTimeout(Exception):
+    pass
+
+# Within deferred_timeout sections a timeout is only recorded and raised when
+# the outermost section is left.
+timeout_deferrals = 0
+timeout_pending = False
+
+def raise_timeout(signum, frame):
+    global timeout_pending
+    if timeout_deferrals:
+        timeout_pending = True
+        return
+    raise TaskTimeout("timed out")
+
+@contextlib.contextmanager
+def deferred_timeout():
+    """Postpone a TaskTimeout raised by the alarm of pipeline_worker until
+    the end of the with block."""
+    global timeout_deferrals, timeout_pending
+    timeout_deferrals += 1
+    try:
+        yield
+    finally:
+        timeout_deferrals -= 1
+    if not timeout_deferrals and timeout_pending:
+        timeout_pending = False
+        raise TaskTimeout("timed out")
+
+worker_cache = None
+worker_downloader = None
+worker_timeout = None
+
+def init_pipeline_worker(cachefile, ratelimit=None, slots=None, timeout=None):
+    """Initialize a long-lived worker process of the pipeline mode.
+    @type timeout: int or None
+    @param timeout: number of seconds after which a package is aborted
+    """
+    global worker_cache, worker_downloader, worker_timeout
+    if cachefile:
+        worker_cache = DerivedHashCache(cachefile)
+    worker_downloader = Downloader(ratelimit, slots)
+    if timeout:
+        worker_timeout = timeout
+        signal.signal(signal.SIGALRM, raise_timeout)
+
+def pipeline_worker(item):
+    """Worker function for the pipeline mode.
+    @type item: (str, dict)
+    @param item: a package name and the package description
+    @returns: a triple of the package name, a description of the error or
+        None and the binary records or None
+    """
+    global timeout_pending
+    name, pkgdict = item
+    print("importing %s" % pkgdict["filename"])
+    if worker_timeout:
+        timeout_pending = False
+        signal.alarm(worker_timeout)
+    try:
+        return name, None, process_pkg_inprocess(pkgdict, worker_cache,
+                                                 worker_downloader)
+    except Exception as exc:
+        return name, repr(exc), None
+    finally:
+        if worker_timeout:
+            signal.alarm(0)
+
 def main():
     parser = optparse.OptionParser()
     parser.add_option("-n", "--new", action="store_true",
                       help="avoid reimporting same versions")
     parser.add_option("-p", "--prune", action="store_true",
                       help="prune packages old packages")
+    parser.add_option("-P", "--pipeline", action="store_true",
+                      help="ignored, the pipeline mode is the default")
+    parser.add_option("-s", "--subprocess", action="store_true",
+                      help="run importpkg.py for every package instead of hashing packages in long-lived worker processes")
+    parser.add_option("-j", "--jobs", action="store", type="int",
+                      default=multiprocessing.cpu_count(),
+                      help="number of worker processes (default: number of cpus)")
+    parser.add_option("-t", "--timeout", action="store", type="int",
+                      help="abort packages taking longer than the given number of seconds (not with -s)")
+    parser.add_option("--max-tasks", action="store", type="int",
+                      help="replace worker processes after importing the given number of packages (not with -s)")
+    parser.add_option("-c", "--cache", action="store",
+                      help="look up derived hashes of files in the given cache file")
+    parser.add_option("-r", "--reimport", action="store_true",
+                      help="import .deb files even if an identical file was imported before")
+    parser.add_option("-b", "--bulk", action="store_true",
+                      help="drop the index on hash values during the import and rebuild it afterwards")
+    parser.add_option("--batch-size", action="store", type="int",
+                      help="maximum number of packages imported in one transaction")
+    parser.add_option("--queue-size", action="store", type="int",
+                      help="maximum number of packages being hashed or waiting to be imported (default: four times the number of jobs)")
+    parser.add_option("--connections", action="store", type="int",
+                      help="maximum number of concurrent downloads (default: number of jobs)")
+    parser.add_option("--limit-rate", action="store", type="int",
+                      help="limit the total download rate to the given number of bytes per second")
     options, args = parser.parse_args()
+    if options.subprocess and (options.timeout or options.max_tasks):
+        parser.error("-t and --max-tasks only apply to the worker processes, not to -s")
+    if not options.connections:
+        options.connections = options.jobs
+    if not options.queue_size:
+        options.queue_size = 4 * options.jobs
     subprocess.check_call(["mkdir", "-p", "tmp"])
     db = sqlite3.connect("test.sqlite3")
     cur = db.cursor()
     cur.execute("PRAGMA foreign_keys = ON;")
-    e = concurrent.futures.ThreadPoolExecutor(multiprocessing.cpu_count())
     pkgs = {}
     for d in args:
         print("processing %s" % d)
@@ -117,26 +395,89 @@ def main():
                     knownpkgs[name]) <= 0:
                 del pkgs[name]
     knownpkgs = set(knownpkgs)
-
-    with e:
-        fs = {}
+    if not options.reimport:
+        cur.execute("SELECT sha256 FROM archive;")
+        knownarchives = set(bytes(row[0]) for row in fetchiter(cur))
+        cur.execute("SELECT package.name, package.version, package.architecture, datamember.size, datamember.mtime FROM datamember JOIN package ON datamember.pid = package.id;")
+        knownpayloads = set(fetchiter(cur))
         for name, pkg in pkgs.items():
-            fs[e.submit(process_pkg, name, pkg)] = name
+            if "sha256hash" in pkg:
+                known = binascii.unhexlify(pkg["sha256hash"]) in knownarchives
+            else:
+                # Local files are recognized by their control information
+                # and data member header without decompressing the data.
+                known = is_known_payload(pkg["filename"], knownpayloads)
+            if known:
+                print("skipping already imported %s" % pkg["filename"])
+                del pkgs[name]
 
-        for f in concurrent.futures.as_completed(fs.keys()):
-            name = fs[f]
-            if f.exception():
-                print("%s failed to import: %r" % (name, f.exception()))
-                continue
-            inf = os.path.join("tmp", name)
-            print("sqlimporting %s" % name)
-            with open(inf) as inp:
-                try:
-                    readyaml(db, inp)
-                except Exception as exc:
-                    print("%s failed sql with exception %r" % (name, exc))
-                else:
-                    os.unlink(inf)
+    # Each downloader gets an equal share of the rate limit, while the
+    # number of concurrent downloads is limited by a shared semaphore.
+    ratelimit = None
+    if options.limit_rate:
+        ratelimit = max(1, options.limit_rate // options.connections)
+    if options.bulk:
+        # Maintaining the index on hash values is expensive during large
+        # imports and it is not needed until update_sharing.py runs.
+        print("dropping hash index")
+        cur.execute("DROP INDEX IF EXISTS hash_hash_index;")
+    try:
+        if not options.subprocess:
+            # At most queuesize packages are being hashed or waiting for the
+            # writer. Thus the workers pause when SQLite is the bottleneck.
+            inflight = threading.Semaphore(options.queue_size)
+            def tasks():
+                for item in pkgs.items():
+                    inflight.acquire()
+                    yield item
+            writer = PackageWriter("test.sqlite3", inflight,
+                                   options.batch_size)
+            writer.start()
+            slots = multiprocessing.BoundedSemaphore(options.connections)
+            pool = multiprocessing.Pool(options.jobs, init_pipeline_worker,
+                                        (options.cache, ratelimit, slots,
+                                         options.timeout),
+                                        options.max_tasks)
+            try:
+                for name, error, records in pool.imap_unordered(
+                        pipeline_worker, tasks()):
+                    if error:
+                        print("%s failed to import: %s" % (name, error))
+                        inflight.release()
+                        continue
+                    writer.put(name, records, pkgs[name].get("sha256hash"))
+            finally:
+                pool.close()
+                pool.join()
+                writer.finish()
+        else:
+            slots = threading.BoundedSemaphore(options.connections)
+            e = concurrent.futures.ThreadPoolExecutor(options.jobs)
+            with e:
+                fs = {}
+                for name, pkg in pkgs.items():
+                    fs[e.submit(process_pkg, name, pkg, options.cache,
+                                ratelimit, slots)] = name
+
+                for f in concurrent.futures.as_completed(fs.keys()):
+                    name = fs[f]
+                    if f.exception():
+                        print("%s failed to import: %r" % (name, f.exception()))
+                        continue
+                    inf = os.path.join("tmp", name)
+                    print("sqlimporting %s" % name)
+                    with open(inf, "rb") as inp:
+                        try:
+                            import_package(db, load_records(inp),
+                                           pkgs[name].get("sha256hash"))
+                        except Exception as exc:
+                            print("%s failed sql with exception %r" % (name, exc))
+                        else:
+                            os.unlink(inf)
+    finally:
+        if options.bulk:
+            print("rebuilding hash index")
+            cur.execute("CREATE INDEX IF NOT EXISTS hash_hash_index ON hash (hash);")
 
     if options.prune:
         delpkgs = knownpkgs - distpkgs
@@ -0,0 +1,158 @@
+#!/usr/bin/python
+"""This tool measures the throughput of DecompressedStream when read in 10 KiB
+chunks like tarfile does, compared to the former implementation that sliced
+its whole buffer on every read. It uses the members of the given .deb files
+or generated data compressed with gzip, bzip2 and xz: text, which compresses
+moderately, and zeros, which expand to large buffers like sparse images or
+padding do. The former implementation mostly suffers from the latter."""
+
+import bz2
+import gzip
+import io
+import optparse
+import os
+import random
+import sys
+import time
+
+import lzma
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from dedup.arreader import ArReader
+from dedup.compression import DecompressedStream, GzipDecompressor
+
+class SlicingStream(object):
+    """The DecompressedStream implementation preceding the buffer reuse,
+    except for tolerating decompressors without flush."""
+    blocksize = 65536
+
+    def __init__(self, fileobj, decompressor):
+        self.fileobj = fileobj
+        self.decompressor = decompressor
+        self.buff = b""
+
+    def read(self, length=None):
+        data = True
+        while True:
+            if length is not None and len(self.buff) >= length:
+                ret = self.buff[:length]
+                self.buff = self.buff[length:]
+                return ret
+            elif not data: # read EOF in last iteration
+                ret = self.buff
+                self.buff = b""
+                return ret
+            data = self.fileobj.read(self.blocksize)
+            if data:
+                self.buff += self.decompressor.decompress(data)
+            elif hasattr(self.decompressor, "flush"):
+                self.buff += self.decompressor.flush()
+
+def gzip_compress(data):
+    output = io.BytesIO()
+    with gzip.GzipFile(fileobj=output, mode="wb") as outp:
+        outp.write(data)
+    return output.getvalue()
+
+decompressors = {
+    ".gz": GzipDecompressor,
+    ".bz2": bz2.BZ2Decompressor,
+    ".xz": lzma.LZMADecompressor,
+}
+
+compressors = {
+    ".gz": gzip_compress,
+    ".bz2": bz2.compress,
+    # a low preset keeps the preparation fast
+    ".xz": lambda data: lzma.compress(data, preset=1),
+}
+
+def generate_text(size):
+    rand = random.Random(0)
+    words = ["".join(rand.choice("abcdefghijklmnopqrstuvwxyz")
+                     for _ in range(rand.randint(2, 10)))
+             for _ in range(4096)]
+    lines = []
+    length = 0
+    while length < size:
+        line = " ".join(rand.choice(words) for _ in range(12)) + "\n"
+        lines.append(line)
+        length += len(line)
+    return "".join(lines).encode("ascii")[:size]
+
+def generated_members(size):
+    """
+    @returns: a list of (label, dict mapping compression extensions to lists
+        of compressed member contents) pairs
+    """
+    result = []
+    for label, data in (("text", generate_text(size)),
+                        ("zeros", b"\0" * size)):
+        result.append((label, dict((extension, [compress(data)])
+                                   for extension, compress
+                                   in compressors.items())))
+    return result
+
+def deb_members(filenames):
+    """
+    @returns: a dict mapping compression extensions to lists of compressed
+        member contents
+    """
+    members = {}
+    for filename in filenames:
+        with open(filename, "rb") as inp:
+            af = ArReader(inp)
+            af.read_magic()
+            while True:
+                try:
+                    name = af.read_entry()
+                except EOFError:
+                    break
+                extension = os.path.splitext(name)[1].decode("ascii")
+                if name.startswith((b"control.tar", b"data.tar")) and \
+                        extension in decompressors:
+                    members.setdefault(extension, []).append(af.read())
+    return members
+
+def measure(streamclass, extension, members, chunksize):
+    """
+    @returns: the number of decompressed bytes and the seconds taken
+    """
+    size = 0
+    start = time.time()
+    for member in members:
+        stream = streamclass(io.BytesIO(member), decompressors[extension]())
+        while True:
+            data = stream.read(chunksize)
+            if not data:
+                break
+            size += len(data)
+    return size, time.time() - start
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options] [deb...]")
+    parser.add_option("-s", "--size", action="store", type="int", default=16,
+                      help="megabytes of generated text when no .deb files are given (default: 16)")
+    parser.add_option("-c", "--chunk-size", action="store", type="int",
+                      default=10240,
+                      help="bytes requested per read (default: 10240)")
+    options, args = parser.parse_args()
+    if args:
+        inputs = [("deb", deb_members(args))]
+    else:
+        inputs = generated_members(options.size * 1024 * 1024)
+    for label, members in inputs:
+        for extension in sorted(members):
+            results = []
+            for streamclass in (SlicingStream, DecompressedStream):
+                size, elapsed = measure(streamclass, extension,
+                                        members[extension],
+                                        options.chunk_size)
+                results.append(size / elapsed / 1e6)
+            print("%-5s %-4s %7.1f MB/s before %7.1f MB/s after (%.1f MB)" %
+                  (label, extension, results[0], results[1], size / 1e6))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+#!/usr/bin/python
+"""This tool compares the strip based pixel hashing of dedup.image with the
+former per pixel struct.pack implementation on the PNG and GIF images found
+below the given directories (/usr/share/icons by default). It asserts that
+both produce identical digests and reports the time spent by each."""
+
+import hashlib
+import io
+import optparse
+import os
+import struct
+import sys
+import time
+
+import PIL.Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from dedup.image import GIFHash, PNGHash
+
+def perpixel_hexdigest(data):
+    """The hexdigest implementation preceding the strip based one."""
+    hashobj = hashlib.sha512()
+    try:
+        img = PIL.Image.open(io.BytesIO(data))
+    except IOError:
+        raise ValueError("broken header")
+    width, height = img.size
+    pack = lambda elem: struct.pack("BBBB", *elem)
+    if img.mode == "L":
+        pack = lambda elem: struct.pack("BBBB", elem, elem, elem, 255)
+    elif img.mode == "RGB":
+        pack = lambda elem: struct.pack("BBBB", *(elem + (255,)))
+    elif img.mode != "RGBA":
+        try:
+            img = img.convert("RGBA")
+        except (SyntaxError, IndexError, IOError):
+            raise ValueError("error reading image")
+    try:
+        for elem in img.getdata():
+            hashobj.update(pack(elem))
+    except (SyntaxError, IndexError, IOError):
+        raise ValueError("error reading image")
+    return "%s%8.8x%8.8x" % (hashobj.hexdigest(), width, height)
+
+def strip_hexdigest(data):
+    if data.startswith(b"\x89PNG"):
+        hashobj = PNGHash(hashlib.sha512())
+    else:
+        hashobj = GIFHash(hashlib.sha512())
+    hashobj.update(data)
+    return hashobj.hexdigest()
+
+def find_images(directories):
+    for directory in directories:
+        for root, _, files in os.walk(directory):
+            for name in files:
+                if name.lower().endswith((".png", ".gif")):
+                    yield os.path.join(root, name)
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options] [directory...]")
+    parser.add_option("-n", "--limit", action="store", type="int",
+                      help="stop after the given number of images")
+    options, args = parser.parse_args()
+    count = skipped = pixels = 0
+    times = [0.0, 0.0]
+    for filename in find_images(args or ["/usr/share/icons"]):
+        if options.limit is not None and count >= options.limit:
+            break
+        with open(filename, "rb") as inp:
+            data = inp.read()
+        digests = []
+        elapsed = []
+        try:
+            for func in (perpixel_hexdigest, strip_hexdigest):
+                start = time.time()
+                digests.append(func(data))
+                elapsed.append(time.time() - start)
+        except ValueError:
+            skipped += 1
+            continue
+        times = [total + part for total, part in zip(times, elapsed)]
+        assert digests[0] == digests[1], "digest mismatch for %s" % filename
+        count += 1
+        pixels += int(digests[0][-16:-8], 16) * int(digests[0][-8:], 16)
+    print("%d images (%d skipped), %.1f Mpixels" %
+          (count, skipped, pixels / 1e6))
+    print("per pixel: %.3fs" % times[0])
+    print("strips:    %.3fs" % times[1])
+    if times[1]:
+        print("speedup:   %.1fx" % (times[0] / times[1]))
+
+if __name__ == "__main__":
+    main()
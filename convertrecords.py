@@ -0,0 +1,32 @@
+#!/usr/bin/python
+"""This tool converts a stream as generated by importpkg.py between the yaml
+and the binary format. It reads the stream from stdin and writes the
+converted stream to stdout."""
+
+import optparse
+import sys
+
+import yaml
+
+from dedup.binformat import dump_records, load_records
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("-f", "--from", action="store", dest="source",
+                      default="yaml", choices=("yaml", "binary"),
+                      help="input format (yaml or binary)")
+    parser.add_option("-t", "--to", action="store", dest="target",
+                      default="binary", choices=("yaml", "binary"),
+                      help="output format (yaml or binary)")
+    options, args = parser.parse_args()
+    if options.source == "binary":
+        gen = load_records(sys.stdin)
+    else:
+        gen = yaml.safe_load_all(sys.stdin)
+    if options.target == "binary":
+        dump_records(gen, sys.stdout)
+    else:
+        yaml.safe_dump_all(gen, sys.stdout)
+
+if __name__ == "__main__":
+    main()
@@ -1,28 +1,95 @@
+import mmap
+import os
 import struct
 
+try:
+    buffer
+except NameError: # Python 3
+    def map_slice(mapping, start, end):
+        return memoryview(mapping)[start:end]
+else:
+    def map_slice(mapping, start, end):
+        return buffer(mapping, start, end - start)
+
+def is_seekable(fileobj):
+    """
+    @returns: whether the file-like object supports tell and seek
+    """
+    try:
+        return fileobj.seekable()
+    except AttributeError:
+        pass
+    try:
+        fileobj.tell()
+    except (AttributeError, IOError):
+        return False
+    return hasattr(fileobj, "seek")
+
 class ArReader(object):
     """Streaming AR file reader. After constructing an object, you usually
     call read_magic once. Then you call read_entry in a loop and use the
     ArReader object as file-like only providing read() to read the respective
     file contents until you get EOFError from read_entry.
+
+    Entries of seekable files are skipped by seeking. Other files are read
+    sequentially in blocks of blocksize bytes. A regular file can also be
+    mapped into memory, so that read_buffer returns the contents without
+    copying them.
     """
     global_magic = b"!<arch>\n"
     file_magic = b"`\n"
+    # number of bytes read at once when skipping entries of unseekable files
+    blocksize = 65536
 
-    def __init__(self, fileobj):
+    def __init__(self, fileobj, blocksize=None, usemmap=False):
         """
-        @param fileobj: a file-like object providing nothing but read(length)
+        @param fileobj: a file-like object providing at least read(length)
+        @type blocksize: int or None
+        @param blocksize: overrides the blocksize class attribute
+        @type usemmap: bool
+        @param usemmap: whether to map fileobj into memory if it is a
+            regular file
         """
         self.fileobj = fileobj
         self.remaining = None
         self.padding = 0
+        self.size = None
+        self.mtime = None
+        if blocksize is not None:
+            self.blocksize = blocksize
+        # the size of a seekable file or None
+        self.end = None
+        # the memory map and the current offset into it, if usemmap
+        self.mapping = None
+        self.pos = None
+        if not is_seekable(fileobj):
+            return
+        pos = fileobj.tell()
+        fileobj.seek(0, os.SEEK_END)
+        self.end = fileobj.tell()
+        fileobj.seek(pos)
+        if usemmap:
+            try:
+                self.mapping = mmap.mmap(fileobj.fileno(), 0,
+                                         access=mmap.ACCESS_READ)
+            except (AttributeError, EnvironmentError, ValueError):
+                pass # not a regular file or empty
+            else:
+                self.pos = pos
+
+    def read_raw(self, length):
+        if self.mapping is None:
+            return self.fileobj.read(length)
+        data = self.mapping[self.pos:self.pos + length]
+        self.pos += len(data)
+        return data
 
     def read_magic(self):
         """Consume the AR magic marker at the beginning of an AR file. You
         must not call any other method before calling this method.
         @raises ValueError: if the magic is not found
         """
-        data = self.fileobj.read(len(self.global_magic))
+        data = self.read_raw(len(self.global_magic))
         if data != self.global_magic:
             raise ValueError("ar global header not found")
         self.remaining = 0
@@ -30,25 +97,32 @@ class ArReader(object):
     def read_entry(self):
         """Read the next file header, return the filename and record the
         length of the next file, so that the read method can be used to
-        exhaustively read the current file.
+        exhaustively read the current file. The size and mtime attributes
+        are set to the respective header fields of the file.
         @rtype: bytes
         @returns: the name of the next file
         @raises ValueError: if the data format is wrong
         @raises EOFError: when the end f the stream is reached
         """
         self.skip_current_entry()
-        if self.padding:
-            if self.fileobj.read(1) != b'\n':
+        # the padding of the previous file is read along with the header
+        file_header = self.read_raw(self.padding + 60)
+        if self.padding and file_header:
+            if file_header[:1] != b'\n':
                 raise ValueError("missing ar padding")
-            self.padding = 0
-        file_header = self.fileobj.read(60)
+            file_header = file_header[1:]
+        self.padding = 0
         if not file_header:
             raise EOFError("end of archive found")
+        if len(file_header) != 60:
+            raise ValueError("ar file header truncated")
         parts = struct.unpack("16s 12s 6s 6s 8s 10s 2s", file_header)
         parts = [p.rstrip(b" ") for p in parts]
         if parts.pop() != self.file_magic:
             raise ValueError("ar file header not found")
         self.remaining = int(parts[5])
+        self.size = self.remaining
+        self.mtime = int(parts[1])
         self.padding = self.remaining % 2
         return parts[0] # name
 
@@ -57,11 +131,24 @@ class ArReader(object):
         called before calling read_entry.
         @raises ValueError: if the archive appears truncated
         """
-        while self.remaining:
-            data = self.fileobj.read(min(4096, self.remaining))
-            if not data:
+        if not self.remaining:
+            return
+        if self.mapping is not None:
+            if self.pos + self.remaining > len(self.mapping):
                 raise ValueError("archive truncated")
-            self.remaining -= len(data)
+            self.pos += self.remaining
+        elif self.end is not None:
+            target = self.fileobj.tell() + self.remaining
+            if target > self.end:
+                raise ValueError("archive truncated")
+            self.fileobj.seek(target)
+        else:
+            while self.remaining:
+                data = self.fileobj.read(min(self.blocksize, self.remaining))
+                if not data:
+                    raise ValueError("archive truncated")
+                self.remaining -= len(data)
+        self.remaining = 0
 
     def read(self, length=None):
         """
@@ -74,6 +161,24 @@ class ArReader(object):
             length = self.remaining
         else:
             length = min(self.remaining, length)
-        data = self.fileobj.read(length)
+        data = self.read_raw(length)
         self.remaining -= len(data)
         return data
+
+    def read_buffer(self, length=None):
+        """Like read, but for memory mapped files a memoryview (a buffer on
+        Python 2) into the mapping is returned instead of a copy.
+        @type length: int or None
+        @param length: number of bytes to read from the current file
+        """
+        if self.mapping is None:
+            return self.read(length)
+        if length is None:
+            length = self.remaining
+        else:
+            length = min(self.remaining, length)
+        end = min(self.pos + length, len(self.mapping))
+        data = map_slice(self.mapping, self.pos, end)
+        self.remaining -= end - self.pos
+        self.pos = end
+        return data
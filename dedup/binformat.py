@@ -0,0 +1,166 @@
+"""A compact binary alternative to the yaml stream emitted by importpkg.py.
+
+A stream starts with the magic b"DEDUP" followed by a version byte. Then a
+sequence of records follows. Each record consists of a tag byte, the length
+of its payload as a varint and the payload. Unknown tags are skipped by
+readers. Strings are stored as a varint length followed by utf8 data. The
+following tags are defined in version 1:
+
+ * P: package metadata. Strings package, source, version and architecture,
+   a varint count of dependencies and the dependency names as strings.
+   Optionally followed by the varint size and mtime of the data member.
+ * F: a file. A string filename, a varint size, a varint count of hashes and
+   for each hash a string function name and the raw digest as string.
+ * C: the commit marker. Empty payload.
+"""
+
+import binascii
+
+magic = b"DEDUP"
+version = 1
+
+def encode_varint(value):
+    """
+    @type value: int
+    @rtype: bytes
+    """
+    result = bytearray()
+    while value > 0x7f:
+        result.append((value & 0x7f) | 0x80)
+        value >>= 7
+    result.append(value)
+    return bytes(result)
+
+def encode_string(value):
+    if not isinstance(value, bytes):
+        value = value.encode("utf8")
+    return encode_varint(len(value)) + value
+
+class Decoder(object):
+    """Sequentially decode values from a record payload."""
+    def __init__(self, payload):
+        """
+        @type payload: bytes
+        """
+        self.payload = bytearray(payload)
+        self.pos = 0
+
+    def varint(self):
+        value = 0
+        shift = 0
+        while True:
+            if self.pos >= len(self.payload):
+                raise ValueError("truncated varint")
+            byte = self.payload[self.pos]
+            self.pos += 1
+            value |= (byte & 0x7f) << shift
+            if not byte & 0x80:
+                return value
+            shift += 7
+
+    def bytes(self):
+        length = self.varint()
+        if self.pos + length > len(self.payload):
+            raise ValueError("truncated string")
+        value = bytes(self.payload[self.pos:self.pos + length])
+        self.pos += length
+        return value
+
+    def string(self):
+        return self.bytes().decode("utf8")
+
+def encode_record(record):
+    """Encode a record as generated by importpkg.process_package.
+    @rtype: bytes
+    """
+    if record == "commit":
+        return b"C" + encode_varint(0)
+    if "hashes" in record:
+        payload = [encode_string(record["name"]), encode_varint(record["size"]),
+                   encode_varint(len(record["hashes"]))]
+        for func, hexhash in sorted(record["hashes"].items()):
+            payload.append(encode_string(func))
+            payload.append(encode_string(binascii.unhexlify(hexhash)))
+        tag = b"F"
+    else:
+        payload = [encode_string(record[key]) for key in
+                   ("package", "source", "version", "architecture")]
+        payload.append(encode_varint(len(record["depends"])))
+        payload.extend(encode_string(dep) for dep in sorted(record["depends"]))
+        if "datasize" in record:
+            payload.append(encode_varint(record["datasize"]))
+            payload.append(encode_varint(record["datamtime"]))
+        tag = b"P"
+    payload = b"".join(payload)
+    return tag + encode_varint(len(payload)) + payload
+
+def decode_record(tag, payload):
+    """
+    @returns: the decoded record or None for unknown tags
+    """
+    if tag == b"C":
+        return "commit"
+    decoder = Decoder(payload)
+    if tag == b"F":
+        record = dict(name=decoder.string(), size=decoder.varint(),
+                      hashes={})
+        for _ in range(decoder.varint()):
+            func = decoder.string()
+            digest = decoder.bytes()
+            record["hashes"][func] = binascii.hexlify(digest).decode("ascii")
+        return record
+    if tag == b"P":
+        record = dict((key, decoder.string()) for key in
+                      ("package", "source", "version", "architecture"))
+        record["depends"] = set(decoder.string()
+                                for _ in range(decoder.varint()))
+        if decoder.pos < len(decoder.payload):
+            record["datasize"] = decoder.varint()
+            record["datamtime"] = decoder.varint()
+        return record
+    return None
+
+def dump_records(records, stream):
+    """Write the records as generated by importpkg.process_package to the
+    given stream in binary format.
+    @param stream: a file-like object providing write
+    """
+    stream.write(magic + bytes(bytearray((version,))))
+    for record in records:
+        stream.write(encode_record(record))
+
+def read_varint(stream):
+    value = 0
+    shift = 0
+    while True:
+        byte = stream.read(1)
+        if not byte:
+            raise ValueError("truncated varint")
+        byte = ord(byte)
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value
+        shift += 7
+
+def load_records(stream):
+    """Read a binary stream as written by dump_records and generate the
+    contained records in the same form as importpkg.process_package.
+    @param stream: a file-like object providing read(size)
+    @raises ValueError: if the stream is malformed or of an unsupported version
+    """
+    header = stream.read(len(magic) + 1)
+    if len(header) <= len(magic) or header[:len(magic)] != magic:
+        raise ValueError("binary record stream magic not found")
+    if bytearray(header[len(magic):])[0] != version:
+        raise ValueError("unsupported binary record stream version")
+    while True:
+        tag = stream.read(1)
+        if not tag:
+            return
+        length = read_varint(stream)
+        payload = stream.read(length)
+        if len(payload) != length:
+            raise ValueError("truncated record")
+        record = decode_record(tag, payload)
+        if record is not None:
+            yield record
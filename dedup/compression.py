@@ -1,6 +1,13 @@
+import bz2
 import struct
 import zlib
 
+import lzma
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 class GzipDecompressor(object):
     """An interface to gzip which is similar to bz2.BZ2Decompressor and
     lzma.LZMADecompressor."""
@@ -21,7 +28,7 @@ class GzipDecompressor(object):
                     return data
                 self.decompressor = None
                 return data + self.decompress(unused_data)
-            self.inbuffer += data
+            self.inbuffer += bytes(data)
             skip = 10
             if len(self.inbuffer) < skip:
                 return b""
@@ -71,33 +78,98 @@ class GzipDecompressor(object):
 
 class DecompressedStream(object):
     """Turn a readable file-like into a decompressed file-like. Te only part
-    of being file-like consists of the read(size) method in both cases."""
+    of being file-like consists of the read(size) and readinto(buffer) methods
+    in both cases."""
     blocksize = 65536
 
     def __init__(self, fileobj, decompressor):
         """
-        @param fileobj: a file-like object providing read(size)
+        @param fileobj: a file-like object providing read(size). If it also
+            provides read_buffer(size) like ArReader, that is used instead
+            to avoid copying the compressed data.
         @param decompressor: a bz2.BZ2Decompressor or lzma.LZMADecompressor
-            like object providing methods decompress and flush and an
-            attribute unused_data
+            like object providing a method decompress and an attribute
+            unused_data. It may provide a flush method.
         """
         self.fileobj = fileobj
+        self.readfunc = getattr(fileobj, "read_buffer", fileobj.read)
         self.decompressor = decompressor
-        self.buff = b""
+        # Decompressed data is buffered in self.buff starting at self.pos.
+        # Consumed data is only discarded when the buffer is refilled, so
+        # reads do not copy the remainder of the buffer.
+        self.buff = bytearray()
+        self.pos = 0
+        self.eof = False
 
-    def read(self, length=None):
-        data = True
-        while True:
-            if length is not None and len(self.buff) >= length:
-                ret = self.buff[:length]
-                self.buff = self.buff[length:]
-                return ret
-            elif not data: # read EOF in last iteration
-                ret = self.buff
-                self.buff = b""
-                return ret
-            data = self.fileobj.read(self.blocksize)
+    def fill(self, length=None):
+        """Decompress until at least length bytes are buffered or the end of
+        the input is reached."""
+        while not self.eof and \
+                (length is None or len(self.buff) - self.pos < length):
+            data = self.readfunc(self.blocksize)
             if data:
-                self.buff += self.decompressor.decompress(data)
+                data = self.decompressor.decompress(data)
             else:
-                self.buff += self.decompressor.flush()
+                data = b""
+                if hasattr(self.decompressor, "flush"):
+                    data = self.decompressor.flush()
+                self.eof = True
+            if self.pos:
+                del self.buff[:self.pos]
+                self.pos = 0
+            self.buff += data
+
+    def read(self, length=None):
+        self.fill(length)
+        end = len(self.buff)
+        if length is not None:
+            end = min(end, self.pos + length)
+        ret = memoryview(self.buff)[self.pos:end].tobytes()
+        self.pos = end
+        return ret
+
+    def readinto(self, buff):
+        """Read decompressed data into a writable buffer.
+        @returns: the number of bytes read
+        """
+        target = memoryview(buff)
+        self.fill(len(target))
+        length = min(len(target), len(self.buff) - self.pos)
+        target[:length] = memoryview(self.buff)[self.pos:self.pos + length]
+        self.pos += length
+        return length
+
+# file extension -> function returning a new decompressor object
+decompressors = {}
+
+def register_decompressor(extension, factory):
+    """Make decompress_stream support another compression format.
+    @type extension: str
+    @param extension: the file extension including the dot (e.g. ".xz")
+    @param factory: a callable without arguments returning a decompressor
+        object as accepted by DecompressedStream
+    """
+    decompressors[extension] = factory
+
+register_decompressor(".gz", GzipDecompressor)
+register_decompressor(".bz2", bz2.BZ2Decompressor)
+register_decompressor(".xz", lzma.LZMADecompressor)
+if zstandard:
+    register_decompressor(".zst",
+                          lambda: zstandard.ZstdDecompressor().decompressobj())
+
+def decompress_stream(fileobj, extension):
+    """Return a decompressed file-like for a file with the given extension.
+    @param fileobj: a file-like object providing read(size)
+    @type extension: str
+    @param extension: the file extension including the dot or the empty
+        string for uncompressed files
+    @raises ValueError: if no decompressor is registered for the extension
+    """
+    if not extension:
+        return fileobj
+    try:
+        factory = decompressors[extension]
+    except KeyError:
+        raise ValueError("unsupported compression %s" % extension)
+    return DecompressedStream(fileobj, factory())
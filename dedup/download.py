@@ -0,0 +1,162 @@
+import socket
+import time
+
+try:
+    import httplib
+except ImportError: # Python 3
+    import http.client as httplib
+try:
+    from urlparse import urlsplit
+except ImportError: # Python 3
+    from urllib.parse import urlsplit
+
+class RateLimiter(object):
+    """A token bucket limiting the throughput to rate bytes per second.
+    Bursts of up to one second worth of data are allowed."""
+    def __init__(self, rate):
+        """
+        @type rate: int
+        @param rate: bytes per second
+        """
+        self.rate = float(rate)
+        self.allowance = self.rate
+        self.last = time.time()
+
+    def consume(self, amount):
+        """Account for amount transferred bytes and sleep if the rate is
+        exceeded."""
+        now = time.time()
+        self.allowance = min(self.rate,
+                             self.allowance + (now - self.last) * self.rate)
+        self.last = now
+        self.allowance -= amount
+        if self.allowance < 0:
+            time.sleep(-self.allowance / self.rate)
+
+class DownloadInterrupted(IOError):
+    """The connection failed while receiving the body of a response."""
+
+class ResponseStream(object):
+    """A file-like providing read(size) for the body of a response. It must
+    be read to the end or closed before the connection can be reused."""
+    def __init__(self, response, limiter=None, slots=None):
+        """
+        @type response: httplib.HTTPResponse
+        @type limiter: RateLimiter or None
+        @param slots: a semaphore released when the stream is closed or None
+        """
+        self.response = response
+        self.limiter = limiter
+        self.slots = slots
+        self.complete = False
+
+    def read(self, size=None):
+        """
+        @raises DownloadInterrupted: if the connection fails before the end
+            of the body was received
+        """
+        try:
+            data = self.response.read(size)
+        except (httplib.HTTPException, socket.error) as exc:
+            self.close()
+            raise DownloadInterrupted("download interrupted: %r" % exc)
+        if data:
+            if self.limiter:
+                self.limiter.consume(len(data))
+        elif self.response.length:
+            self.close()
+            raise DownloadInterrupted("download truncated")
+        else:
+            self.complete = True
+            self.close()
+        return data
+
+    def close(self):
+        self.response.close()
+        if self.slots is not None:
+            self.slots.release()
+            self.slots = None
+
+class Downloader(object):
+    """Download files over http reusing one keep-alive connection per host.
+    An object must not be used by multiple threads at the same time."""
+    retries = 3
+    timeout = 60
+
+    def __init__(self, ratelimit=None, slots=None, retries=None):
+        """
+        @type ratelimit: int or None
+        @param ratelimit: maximum number of bytes per second to download
+        @param slots: a threading or multiprocessing semaphore shared between
+            downloaders limiting the number of concurrent downloads or None
+        @type retries: int or None
+        @param retries: overrides the retries class attribute
+        """
+        self.limiter = RateLimiter(ratelimit) if ratelimit else None
+        self.slots = slots
+        if retries is not None:
+            self.retries = retries
+        # netloc -> (HTTPConnection, last ResponseStream or None)
+        self.connections = {}
+
+    def request(self, netloc, path):
+        conn, stream = self.connections.get(netloc, (None, None))
+        if stream is not None and not stream.complete:
+            # unread parts of the body would be taken as the next response
+            conn.close()
+            conn = None
+        if conn is None:
+            conn = httplib.HTTPConnection(netloc, timeout=self.timeout)
+            self.connections[netloc] = conn, None
+        try:
+            conn.request("GET", path)
+            return conn.getresponse()
+        except Exception:
+            # e.g. the server closed an idle keep-alive connection
+            conn.close()
+            del self.connections[netloc]
+            raise
+
+    def request_retrying(self, url):
+        parts = urlsplit(url)
+        if parts.scheme != "http":
+            raise ValueError("unsupported url %s" % url)
+        path = parts.path
+        if parts.query:
+            path += "?" + parts.query
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(attempt - 1)
+            try:
+                response = self.request(parts.netloc, path)
+            except (httplib.HTTPException, socket.error) as exc:
+                error = exc
+                continue
+            if response.status == 200:
+                return response
+            response.read()
+            error = "http status %d" % response.status
+            if response.status < 500:
+                break
+        raise IOError("download of %s failed: %s" % (url, error))
+
+    def open(self, url):
+        """Request the given url. Failing requests are retried up to retries
+        times, waiting a little longer after each attempt.
+        @type url: str
+        @returns: a ResponseStream for the body
+        @raises ValueError: for urls other than http
+        @raises IOError: if the download fails
+        """
+        if self.slots is not None:
+            self.slots.acquire()
+        try:
+            response = self.request_retrying(url)
+        except Exception:
+            if self.slots is not None:
+                self.slots.release()
+            raise
+        stream = ResponseStream(response, self.limiter, self.slots)
+        netloc = urlsplit(url).netloc
+        self.connections[netloc] = self.connections[netloc][0], stream
+        return stream
@@ -0,0 +1,106 @@
+import sqlite3
+import time
+
+class DerivedHashCache(object):
+    """A persistent mapping from the sha512 digest of a file to the hashes
+    derived from its contents such as gzip_sha512 or png_sha512. It is stored
+    in an SQLite database, that can be shared between processes. The number of
+    entries is bounded by evicting the least recently used ones. Failing
+    database operations, e.g. because another process holds the lock for too
+    long or the disk is full, are treated like cache misses.
+    """
+    # members larger than this are not buffered for looking them up
+    maxsize = 1024 * 1024 * 32
+    maxentries = 1024 * 1024
+
+    def __init__(self, filename, maxentries=None):
+        """
+        @param filename: the database file. It is created if missing.
+        @type maxentries: int or None
+        @param maxentries: number of entries to keep
+        """
+        if maxentries is not None:
+            self.maxentries = maxentries
+        self.db = sqlite3.connect(filename, timeout=60)
+        cur = self.db.cursor()
+        cur.execute("PRAGMA journal_mode = WAL;")
+        cur.execute("CREATE TABLE IF NOT EXISTS derived (sha512 BLOB PRIMARY KEY, hashes TEXT, atime REAL);")
+        cur.execute("CREATE INDEX IF NOT EXISTS derived_atime_index ON derived (atime);")
+        self.db.commit()
+        self.touched = set()
+        self.added = False
+
+    def get(self, digest):
+        """
+        @type digest: bytes
+        @param digest: the raw sha512 digest of a file
+        @rtype: dict or None
+        @returns: a mapping from hash function names to hex encoded hash
+            values or None if the digest is not in the cache
+        """
+        cur = self.db.cursor()
+        try:
+            cur.execute("SELECT hashes FROM derived WHERE sha512 = ?;",
+                        (sqlite3.Binary(digest),))
+            row = cur.fetchone()
+        except sqlite3.OperationalError:
+            return None
+        if row is None:
+            return None
+        self.touched.add(digest)
+        return dict(item.split(":", 1) for item in row[0].split())
+
+    def put(self, digest, hashes):
+        """Add an entry and commit it right away, so that the database is not
+        locked for other processes while a package is being hashed.
+        @type digest: bytes
+        @param digest: the raw sha512 digest of a file
+        @type hashes: dict
+        @param hashes: a mapping from hash function names to hex encoded hash
+            values. It may be empty.
+        """
+        try:
+            self.db.execute("INSERT OR REPLACE INTO derived (sha512, hashes, atime) VALUES (?, ?, ?);",
+                            (sqlite3.Binary(digest),
+                             " ".join("%s:%s" % item
+                                      for item in hashes.items()),
+                             time.time()))
+            self.db.commit()
+        except sqlite3.OperationalError:
+            self.db.rollback()
+            return
+        except BaseException:
+            # e.g. a timeout signal, which must not leave the database locked
+            self.db.rollback()
+            raise
+        self.added = True
+
+    def commit(self):
+        """Record accesses and evict old entries. If the database cannot be
+        updated, the accesses are forgotten.
+        """
+        cur = self.db.cursor()
+        now = time.time()
+        touched = self.touched
+        self.touched = set()
+        try:
+            cur.executemany("UPDATE derived SET atime = ? WHERE sha512 = ?;",
+                            ((now, sqlite3.Binary(digest))
+                             for digest in touched))
+            if self.added:
+                cur.execute("SELECT count(*) FROM derived;")
+                excess = cur.fetchone()[0] - self.maxentries
+                if excess > 0:
+                    cur.execute("DELETE FROM derived WHERE sha512 IN (SELECT sha512 FROM derived ORDER BY atime LIMIT ?);",
+                                (excess,))
+                self.added = False
+            self.db.commit()
+        except sqlite3.OperationalError:
+            self.db.rollback()
+        except BaseException:
+            self.db.rollback()
+            raise
+
+    def close(self):
+        self.commit()
+        self.db.close()
@@ -1,16 +1,28 @@
-import io
+import shutil
 import struct
+import tempfile
 
 import PIL.Image
 
+def image_bytes(img):
+    try:
+        return img.tobytes()
+    except AttributeError: # PIL before Pillow 2.0
+        return img.tostring()
+
 class ImageHash(object):
     """A hash on the contents of an image datat type supported by PIL. This
     disregards mode, depth and meta information. Note that due to limitations
     in PIL and the image format (interlacing) the full contents are stored and
-    decoded in hexdigest."""
+    decoded in hexdigest. Contents exceeding spoolsize are stored in a
+    temporary file."""
     maxsize = 1024 * 1024 * 32
     # max memory usage is about 5 * maxpixels in bytes
     maxpixels = 1024 * 1024 * 32
+    stripsize = 1024 * 1024
+    spoolsize = 1024 * 1024
+    # number of leading bytes needed by detect
+    headersize = 0
 
     def __init__(self, hashobj):
         """
@@ -18,9 +30,14 @@ class ImageHash(object):
         """
         self.hashobj = hashobj
         self.imagedetected = False
-        self.content = io.BytesIO()
+        self.header = b""
+        self.content = tempfile.SpooledTemporaryFile(self.spoolsize)
 
     def detect(self):
+        """Examine self.header, which is filled up to headersize bytes.
+        @returns: whether an image was detected
+        @raises ValueError: if the contents are not a supported image
+        """
         raise NotImplementedError
 
     def update(self, data):
@@ -28,12 +45,17 @@ class ImageHash(object):
         if self.content.tell() > self.maxsize:
             raise ValueError("maximum image size exceeded")
         if not self.imagedetected:
+            self.header += data[:self.headersize - len(self.header)]
             self.imagedetected = self.detect()
 
     def copy(self):
         new = self.__class__(self.hashobj.copy())
         new.imagedetected = self.imagedetected
-        new.content = io.BytesIO(self.content.getvalue())
+        new.header = self.header
+        pos = self.content.tell()
+        self.content.seek(0)
+        shutil.copyfileobj(self.content, new.content)
+        self.content.seek(pos)
         return new
 
     def hexdigest(self):
@@ -48,21 +70,22 @@ class ImageHash(object):
             except IOError:
                 raise ValueError("broken header")
             width, height = img.size
-            pack = lambda elem: struct.pack("BBBB", *elem)
             # special casing easy modes reduces memory usage
-            if img.mode == "L":
-                pack = lambda elem: struct.pack("BBBB", elem, elem, elem, 255)
-            elif img.mode == "RGB":
-                pack = lambda elem: struct.pack("BBBB", *(elem + (255,)))
-            elif img.mode != "RGBA":
+            if img.mode not in ("L", "RGB", "RGBA"):
                 try:
                     img = img.convert("RGBA")
                 except (SyntaxError, IndexError, IOError):
                     # crazy stuff from PIL
                     raise ValueError("error reading image")
+            # Hash the RGBA pixels in strips of about stripsize bytes to
+            # avoid converting the whole image at once.
+            rows = max(1, self.stripsize // (4 * max(width, 1)))
             try:
-                for elem in img.getdata():
-                    hashobj.update(pack(elem))
+                for top in range(0, height, rows):
+                    strip = img.crop((0, top, width, min(top + rows, height)))
+                    if strip.mode != "RGBA":
+                        strip = strip.convert("RGBA")
+                    hashobj.update(image_bytes(strip))
             except (SyntaxError, IndexError, IOError): # crazy stuff from PIL
                 raise ValueError("error reading image")
         finally:
@@ -72,13 +95,13 @@ class ImageHash(object):
 
 class PNGHash(ImageHash):
     """A hash on the contents of a PNG image."""
+    headersize = 33 # header + IHDR
 
     def detect(self):
-        if self.content.tell() < 33: # header + IHDR
+        if len(self.header) < self.headersize:
             return False
-        curvalue = self.content.getvalue()
-        if curvalue.startswith(b"\x89PNG\r\n\x1a\n\0\0\0\x0dIHDR"):
-            width, height = struct.unpack(">II", curvalue[16:24])
+        if self.header.startswith(b"\x89PNG\r\n\x1a\n\0\0\0\x0dIHDR"):
+            width, height = struct.unpack(">II", self.header[16:24])
             if width * height > self.maxpixels:
                 raise ValueError("maximum image pixels exceeded")
             return True
@@ -86,13 +109,13 @@ class PNGHash(ImageHash):
 
 class GIFHash(ImageHash):
     """A hash on the contents of the first frame of a GIF image."""
+    headersize = 10 # magic + logical dimension
 
     def detect(self):
-        if self.content.tell() < 10: # magic + logical dimension
+        if len(self.header) < self.headersize:
             return False
-        curvalue = self.content.getvalue()
-        if curvalue.startswith((b"GIF87a", "GIF89a")):
-            width, height = struct.unpack("<HH", curvalue[6:10])
+        if self.header.startswith((b"GIF87a", b"GIF89a")):
+            width, height = struct.unpack("<HH", self.header[6:10])
             if width * height > self.maxpixels:
                 raise ValueError("maximum image pixels exceeded")
             return True
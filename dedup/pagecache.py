@@ -0,0 +1,105 @@
+import collections
+import hashlib
+import os
+import tempfile
+import threading
+
+class PageCache(object):
+    """A cache of rendered pages in memory and optionally on disk. Pages are
+    stored for a database generation and all pages of older generations are
+    discarded once a newer generation is seen. The memory part evicts the
+    least recently used pages when exceeding maxsize bytes. The disk part is
+    not bounded except by the generation. The object may be shared between
+    threads."""
+    maxsize = 64 * 1024 * 1024
+
+    def __init__(self, maxsize=None, directory=None):
+        """
+        @type maxsize: int or None
+        @param maxsize: overrides the maxsize class attribute
+        @type directory: str or None
+        @param directory: where to store pages on disk. It is created if
+            missing.
+        """
+        if maxsize is not None:
+            self.maxsize = maxsize
+        self.directory = directory
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.lock = threading.Lock()
+        self.generation = None
+        self.pages = collections.OrderedDict()
+        self.size = 0
+
+    def check_generation(self, generation):
+        """Drop all pages unless they belong to the given generation. Must be
+        called with self.lock held."""
+        if generation == self.generation:
+            return
+        self.pages.clear()
+        self.size = 0
+        self.generation = generation
+        if self.directory:
+            prefix = "%d-" % generation
+            for name in os.listdir(self.directory):
+                # dot files are being written
+                if not name.startswith((prefix, ".")):
+                    try:
+                        os.unlink(os.path.join(self.directory, name))
+                    except OSError:
+                        pass # removed by another process
+
+    def filename(self, key, generation):
+        digest = hashlib.sha1(key.encode("utf8")).hexdigest()
+        return os.path.join(self.directory, "%d-%s" % (generation, digest))
+
+    def get(self, key, generation):
+        """
+        @type key: unicode
+        @type generation: int
+        @rtype: bytes or None
+        @returns: the cached page or None
+        """
+        with self.lock:
+            self.check_generation(generation)
+            try:
+                page = self.pages.pop(key)
+            except KeyError:
+                pass
+            else:
+                self.pages[key] = page # move to the end
+                return page
+        if not self.directory:
+            return None
+        try:
+            with open(self.filename(key, generation), "rb") as inp:
+                page = inp.read()
+        except IOError:
+            return None
+        self.put(key, generation, page, False)
+        return page
+
+    def put(self, key, generation, page, store=True):
+        """
+        @type key: unicode
+        @type generation: int
+        @type page: bytes
+        @type store: bool
+        @param store: whether to write the page to disk
+        """
+        with self.lock:
+            self.check_generation(generation)
+            if key in self.pages:
+                self.size -= len(self.pages.pop(key))
+            if len(page) <= self.maxsize:
+                self.pages[key] = page
+                self.size += len(page)
+            while self.size > self.maxsize:
+                _, old = self.pages.popitem(last=False)
+                self.size -= len(old)
+        if self.directory and store:
+            # write atomically for concurrent readers
+            fd, tmpname = tempfile.mkstemp(dir=self.directory, prefix=".")
+            with os.fdopen(fd, "wb") as outp:
+                outp.write(page)
+            os.rename(tmpname, self.filename(key, generation))
@@ -1,33 +1,73 @@
 #!/usr/bin/python
 """This tool reads a debian package from stdin and emits a yaml stream on
-stdout.  It does not access a database. Therefore it can be run in parallel and
+stdout. Alternatively a binary stream as described in dedup.binformat can be
+emitted.  It does not access a database. Therefore it can be run in parallel and
 on multiple machines. The generated yaml conatins multiple documents. The first
 document contains package metadata. Then a document is emitted for each file.
 And finally a document consisting of the string "commit" is emitted."""
 
 import hashlib
+import io
 import optparse
 import sys
 import tarfile
 import zlib
 
 from debian import deb822
-import lzma
 import yaml
 
 from dedup.arreader import ArReader
+from dedup.binformat import dump_records
 from dedup.hashing import HashBlacklist, DecompressedHash, SuppressingHash, \
     HashedStream, hash_file
-from dedup.compression import GzipDecompressor, DecompressedStream
+from dedup.compression import GzipDecompressor, decompress_stream
+from dedup.hashcache import DerivedHashCache
 from dedup.image import GIFHash, PNGHash
 
+# Hashes named here only produce a value for contents starting with one of
+# the given magics.
+hash_magics = {
+    "gzip_sha512": (b"\037\213\010",),
+    "png_sha512": (b"\x89PNG\r\n\x1a\n",),
+    "gif_sha512": (b"GIF87a", b"GIF89a"),
+}
+
+# Contents not starting with one of these cannot have a derived hash.
+derived_magics = tuple(magic for magics in hash_magics.values()
+                       for magic in magics)
+
+# hash name -> [number of files, number of bytes] not fed to that hash due to
+# sniffing
+sniff_stats = dict((name, [0, 0]) for name in hash_magics)
+
 class MultiHash(object):
+    """Feed data to multiple hashes. On the first update the data is sniffed
+    and hashes listed in hash_magics are dropped if the data does not start
+    with one of their magics. Thus the first update must contain the entire
+    contents if they are shorter than the longest magic."""
     def __init__(self, *hashes):
         self.hashes = hashes
+        self.pruned = None
+
+    def sniff(self, data):
+        hashes = []
+        self.pruned = []
+        for hasher in self.hashes:
+            magics = hash_magics.get(hasher.name)
+            if magics and not data.startswith(magics):
+                self.pruned.append(sniff_stats[hasher.name])
+                self.pruned[-1][0] += 1
+            else:
+                hashes.append(hasher)
+        self.hashes = hashes
 
     def update(self, data):
+        if self.pruned is None:
+            self.sniff(data)
         for hasher in self.hashes:
             hasher.update(data)
+        for stats in self.pruned:
+            stats[1] += len(data)
 
 boring_sha512_hashes = set((
     # ""
@@ -56,19 +96,55 @@ def gifhash():
     hashobj.name = "gif_sha512"
     return hashobj
 
-def get_hashes(tar):
+def compute_hashes(hashers, filelike):
+    hasher = hash_file(MultiHash(*hashers), filelike)
+    hashes = {}
+    for hashobj in hasher.hashes:
+        hashvalue = hashobj.hexdigest()
+        if hashvalue:
+            hashes[hashobj.name] = hashvalue
+    return hashes
+
+def compute_hashes_cached(cache, filelike):
+    """Compute the same hashes as compute_hashes with all hash functions, but
+    look up the derived hashes in the given cache by the sha512 of the
+    contents. The entire contents are read into memory.
+    @type cache: DerivedHashCache
+    """
+    data = filelike.read()
+    sha512 = hashlib.sha512(data)
+    hashes = {}
+    hexvalue = sha512.hexdigest()
+    if hexvalue not in boring_sha512_hashes:
+        hashes["sha512"] = hexvalue
+    if not data.startswith(derived_magics):
+        return hashes
+    derived = cache.get(sha512.digest())
+    if derived is None:
+        derived = compute_hashes((gziphash(), pnghash(), gifhash()),
+                                 io.BytesIO(data))
+        cache.put(sha512.digest(), derived)
+    hashes.update(derived)
+    return hashes
+
+def get_hashes(tar, cache=None):
+    """
+    @type cache: DerivedHashCache or None
+    @param cache: if given, derived hashes are looked up in and added to this
+        cache
+    """
     for elem in tar:
         if not elem.isreg(): # excludes hard links as well
             continue
-        hasher = MultiHash(sha512_nontrivial(), gziphash(), pnghash(),
-                           gifhash())
-        hasher = hash_file(hasher, tar.extractfile(elem))
-        hashes = {}
-        for hashobj in hasher.hashes:
-            hashvalue = hashobj.hexdigest()
-            if hashvalue:
-                hashes[hashobj.name] = hashvalue
+        if cache is not None and elem.size <= cache.maxsize:
+            hashes = compute_hashes_cached(cache, tar.extractfile(elem))
+        else:
+            hashes = compute_hashes((sha512_nontrivial(), gziphash(),
+                                     pnghash(), gifhash()),
+                                    tar.extractfile(elem))
         yield (elem.name, elem.size, hashes)
+    if cache is not None:
+        cache.commit()
 
 def process_control(control_contents):
     control = deb822.Packages(control_contents)
@@ -86,43 +162,49 @@ def process_control(control_contents):
     return dict(package=package, source=source, version=version,
                 architecture=architecture, depends=depends)
 
-def process_package(filelike):
-    af = ArReader(filelike)
+def process_package(filelike, cache=None, usemmap=False):
+    """Generate the metadata record, a record per file and the commit
+    marker. The metadata record includes the size and mtime of the data
+    member as datasize and datamtime. It is generated before the data member
+    is decompressed, so callers only interested in it can stop there.
+    @type cache: DerivedHashCache or None
+    @param cache: passed to get_hashes
+    @type usemmap: bool
+    @param usemmap: passed to ArReader
+    """
+    af = ArReader(filelike, usemmap=usemmap)
     af.read_magic()
     state = "start"
+    metadata = None
     while True:
         try:
             name = af.read_entry()
         except EOFError:
             raise ValueError("data.tar not found")
-        if name == "control.tar.gz":
+        if name.startswith("control.tar"):
             if state != "start":
-                raise ValueError("unexpected control.tar.gz")
+                raise ValueError("unexpected %s" % name)
             state = "control"
-            tf = tarfile.open(fileobj=af, mode="r|gz")
+            tf = tarfile.open(fileobj=decompress_stream(af, name[11:]),
+                              mode="r|")
             for elem in tf:
                 if elem.name != "./control":
                     continue
                 if state != "control":
                     raise ValueError("duplicate control file")
                 state = "control_file"
-                yield process_control(tf.extractfile(elem).read())
+                metadata = process_control(tf.extractfile(elem).read())
                 break
             continue
-        elif name == "data.tar.gz":
-            tf = tarfile.open(fileobj=af, mode="r|gz")
-        elif name == "data.tar.bz2":
-            tf = tarfile.open(fileobj=af, mode="r|bz2")
-        elif name == "data.tar.xz":
-            zf = DecompressedStream(af, lzma.LZMADecompressor())
-            tf = tarfile.open(fileobj=zf, mode="r|")
-        elif name == "data.tar":
-            tf = tarfile.open(fileobj=af, mode="r|")
-        else:
+        elif not name.startswith("data.tar"):
             continue
         if state != "control_file":
             raise ValueError("missing control file")
-        for name, size, hashes in get_hashes(tf):
+        metadata["datasize"] = af.size
+        metadata["datamtime"] = af.mtime
+        yield metadata
+        tf = tarfile.open(fileobj=decompress_stream(af, name[8:]), mode="r|")
+        for name, size, hashes in get_hashes(tf, cache):
             try:
                 name = name.decode("utf8")
             except UnicodeDecodeError:
@@ -132,9 +214,9 @@ def process_package(filelike):
         yield "commit"
         break
 
-def process_package_with_hash(filelike, sha256hash):
+def process_package_with_hash(filelike, sha256hash, cache=None):
     hstream = HashedStream(filelike, hashlib.sha256())
-    for elem in process_package(hstream):
+    for elem in process_package(hstream, cache):
         if elem == "commit":
             while hstream.read(4096):
                 pass
@@ -148,12 +230,35 @@ def main():
     parser = optparse.OptionParser()
     parser.add_option("-H", "--hash", action="store",
                       help="verify that stdin hash given sha256 hash")
+    parser.add_option("-f", "--format", action="store", default="yaml",
+                      choices=("yaml", "binary"),
+                      help="output format (yaml or binary)")
+    parser.add_option("-c", "--cache", action="store",
+                      help="look up derived hashes in the given cache file")
+    parser.add_option("-s", "--stats", action="store_true",
+                      help="report the work avoided by file type sniffing on stderr")
+    parser.add_option("-m", "--mmap", action="store_true",
+                      help="map stdin into memory if it is a regular file")
+    parser.add_option("--cache-entries", action="store", type="int",
+                      help="maximum number of entries to keep in the cache")
     options, args = parser.parse_args()
+    cache = None
+    if options.cache:
+        cache = DerivedHashCache(options.cache, options.cache_entries)
     if options.hash:
-        gen = process_package_with_hash(sys.stdin, options.hash)
+        gen = process_package_with_hash(sys.stdin, options.hash, cache)
+    else:
+        gen = process_package(sys.stdin, cache, usemmap=options.mmap)
+    if options.format == "binary":
+        dump_records(gen, sys.stdout)
     else:
-        gen = process_package(sys.stdin)
-    yaml.safe_dump_all(gen, sys.stdout)
+        yaml.safe_dump_all(gen, sys.stdout)
+    if cache is not None:
+        cache.close()
+    if options.stats:
+        for name, (files, size) in sorted(sniff_stats.items()):
+            sys.stderr.write("%s skipped for %d files with %d bytes\n" %
+                             (name, files, size))
 
 if __name__ == "__main__":
     main()
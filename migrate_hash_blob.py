@@ -0,0 +1,39 @@
+#!/usr/bin/python
+"""This tool converts a database created with an older schema.sql, which
+stored hashes as hex encoded TEXT, to store them as raw BLOBs like the current
+schema does. Run VACUUM afterwards to actually reclaim the space."""
+
+import binascii
+import sqlite3
+
+def unhex(value):
+    if value is None:
+        return None
+    return sqlite3.Binary(binascii.unhexlify(value))
+
+def main():
+    db = sqlite3.connect("test.sqlite3", isolation_level=None)
+    db.create_function("unhex", 1, unhex)
+    cur = db.cursor()
+    cur.execute("PRAGMA foreign_keys = OFF;")
+    # Keep triggers referencing the hash table intact while renaming.
+    cur.execute("PRAGMA legacy_alter_table = ON;")
+    cur.execute("BEGIN;")
+    cur.execute("CREATE TABLE newhash (cid INTEGER, fid INTEGER NOT NULL, hash BLOB, FOREIGN KEY (cid) REFERENCES content(id) ON DELETE CASCADE, FOREIGN KEY (fid) REFERENCES function(id));")
+    print("converting hash table")
+    cur.execute("INSERT INTO newhash (cid, fid, hash) SELECT cid, fid, CASE WHEN typeof(hash) = 'text' THEN unhex(hash) ELSE hash END FROM hash;")
+    cur.execute("DROP TABLE hash;")
+    cur.execute("ALTER TABLE newhash RENAME TO hash;")
+    print("recreating indices")
+    cur.execute("CREATE INDEX hash_cid_index ON hash (cid);")
+    cur.execute("CREATE INDEX hash_hash_index ON hash (hash);")
+    cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'dirtyhash';")
+    if cur.fetchone():
+        cur.execute("CREATE TABLE newdirtyhash (hash BLOB PRIMARY KEY);")
+        cur.execute("INSERT OR IGNORE INTO newdirtyhash (hash) SELECT CASE WHEN typeof(hash) = 'text' THEN unhex(hash) ELSE hash END FROM dirtyhash;")
+        cur.execute("DROP TABLE dirtyhash;")
+        cur.execute("ALTER TABLE newdirtyhash RENAME TO dirtyhash;")
+    cur.execute("COMMIT;")
+
+if __name__ == "__main__":
+    main()
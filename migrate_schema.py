@@ -0,0 +1,30 @@
+#!/usr/bin/python
+"""This tool adds the tables and triggers introduced to schema.sql after a
+database was created. It can be run repeatedly, existing objects are left
+alone. Hashes stored as hex TEXT are converted by migrate_hash_blob.py."""
+
+import sqlite3
+
+statements = [
+    "CREATE TABLE IF NOT EXISTS archive (sha256 BLOB PRIMARY KEY, pid INTEGER NOT NULL REFERENCES package(id) ON DELETE CASCADE);",
+    "CREATE TABLE IF NOT EXISTS datamember (pid INTEGER PRIMARY KEY REFERENCES package(id) ON DELETE CASCADE, size INTEGER, mtime INTEGER);",
+    "CREATE TABLE IF NOT EXISTS dirtypackage (pid INTEGER PRIMARY KEY REFERENCES package(id) ON DELETE CASCADE);",
+    "CREATE TABLE IF NOT EXISTS dirtyhash (hash BLOB PRIMARY KEY);",
+    """CREATE TRIGGER IF NOT EXISTS package_insert_trigger AFTER INSERT ON package BEGIN
+	INSERT INTO dirtypackage (pid) VALUES (NEW.id);
+END;""",
+    """CREATE TRIGGER IF NOT EXISTS package_delete_trigger BEFORE DELETE ON package BEGIN
+	INSERT OR IGNORE INTO dirtyhash (hash) SELECT hash.hash FROM hash JOIN content ON hash.cid = content.id WHERE content.pid = OLD.id;
+END;""",
+]
+
+def main():
+    db = sqlite3.connect("test.sqlite3", isolation_level=None)
+    cur = db.cursor()
+    cur.execute("BEGIN;")
+    for statement in statements:
+        cur.execute(statement)
+    cur.execute("COMMIT;")
+
+if __name__ == "__main__":
+    main()
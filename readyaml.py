@@ -1,17 +1,31 @@
 #!/usr/bin/python
 """This tool reads a yaml file as generated by importpkg.py on stdin and
-updates the database with the contents."""
+updates the database with the contents. With -f binary it reads the binary
+format instead."""
 
+import binascii
+import optparse
 import sqlite3
 import sys
 
 from debian.debian_support import version_compare
 import yaml
 
-def readyaml(db, stream):
-    cur = db.cursor()
-    cur.execute("PRAGMA foreign_keys = ON;")
-    gen = yaml.safe_load_all(stream)
+from dedup.binformat import load_records
+
+def insert_package(cur, gen, sha256hash=None):
+    """Insert the records of one package within the current transaction.
+    If a newer version of the package is already present, nothing is
+    changed.
+    @type cur: sqlite3.Cursor
+    @param gen: an iterator over the records as generated by
+        importpkg.process_package
+    @type sha256hash: str or None
+    @param sha256hash: the hex encoded sha256 hash of the .deb file. If given,
+        it is recorded in the archive table, so that the same file is not
+        imported again.
+    @raises ValueError: if the records are incomplete
+    """
     metadata = next(gen)
     package = metadata["package"]
     cur.execute("SELECT id, version FROM package WHERE name = ?;",
@@ -29,7 +43,6 @@ def readyaml(db, stream):
     else:
         pid = None
 
-    cur.execute("BEGIN;")
     cur.execute("SELECT name, id FROM function;")
     funcmapping = dict(cur.fetchall())
 
@@ -50,24 +63,65 @@ def readyaml(db, stream):
                 (package, metadata["version"], metadata["architecture"],
                  metadata["source"]))
     pid = cur.lastrowid
+    if sha256hash:
+        cur.execute("INSERT OR REPLACE INTO archive (sha256, pid) VALUES (?, ?);",
+                    (sqlite3.Binary(binascii.unhexlify(sha256hash)), pid))
+    if "datasize" in metadata:
+        cur.execute("INSERT INTO datamember (pid, size, mtime) VALUES (?, ?, ?);",
+                    (pid, metadata["datasize"], metadata["datamtime"]))
     cur.executemany("INSERT INTO dependency (pid, required) VALUES (?, ?);",
                     ((pid, dep) for dep in metadata["depends"]))
+
+    # The package row was just inserted, so this transaction holds the write
+    # lock and the content ids following the largest one can be assigned
+    # here. That way whole packages are inserted with executemany.
+    cur.execute("SELECT max(id) FROM content;")
+    cid = cur.fetchone()[0] or 0
+    contents = []
+    hashes = []
     for entry in gen:
         if entry == "commit":
-            db.commit()
-            return
+            break
+        cid += 1
+        contents.append((cid, pid, entry["name"], entry["size"]))
+        hashes.extend((cid, funcmapping[func],
+                       sqlite3.Binary(binascii.unhexlify(hexhash)))
+                      for func, hexhash in entry["hashes"].items())
+    else:
+        raise ValueError("missing commit block")
+    cur.executemany("INSERT INTO content (id, pid, filename, size) VALUES (?, ?, ?, ?);",
+                    contents)
+    cur.executemany("INSERT INTO hash (cid, fid, hash) VALUES (?, ?, ?);",
+                    hashes)
 
-        cur.execute("INSERT INTO content (pid, filename, size) VALUES (?, ?, ?);",
-                    (pid, entry["name"], entry["size"]))
-        cid = cur.lastrowid
-        cur.executemany("INSERT INTO hash (cid, fid, hash) VALUES (?, ?, ?);",
-                        ((cid, funcmapping[func], hexhash)
-                         for func, hexhash in entry["hashes"].items()))
-    raise ValueError("missing commit block")
+def import_package(db, gen, sha256hash=None):
+    """Update the database with the records of one package in a transaction
+    of its own. See insert_package for the parameters.
+    """
+    cur = db.cursor()
+    cur.execute("PRAGMA foreign_keys = ON;")
+    cur.execute("BEGIN;")
+    try:
+        insert_package(cur, gen, sha256hash)
+    except:
+        db.rollback()
+        raise
+    db.commit()
+
+def readyaml(db, stream):
+    import_package(db, yaml.safe_load_all(stream))
 
 def main():
+    parser = optparse.OptionParser()
+    parser.add_option("-f", "--format", action="store", default="yaml",
+                      choices=("yaml", "binary"),
+                      help="input format (yaml or binary)")
+    options, args = parser.parse_args()
     db = sqlite3.connect("test.sqlite3")
-    readyaml(db, sys.stdin)
+    if options.format == "binary":
+        import_package(db, load_records(sys.stdin))
+    else:
+        readyaml(db, sys.stdin)
 
 if __name__ == "__main__":
     main()
@@ -4,7 +4,7 @@ CREATE UNIQUE INDEX package_name_version_index ON package (name, version);
 CREATE TABLE content (id INTEGER PRIMARY KEY, pid INTEGER, filename TEXT, size INTEGER, FOREIGN KEY (pid) REFERENCES package(id) ON DELETE CASCADE);
 CREATE TABLE function (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL, eqclass INTEGER);
 INSERT INTO function (name, eqclass) VALUES ("sha512", 1), ("gzip_sha512", 1), ("png_sha512", 2), ("gif_sha512", 2);
-CREATE TABLE hash (cid INTEGER, fid INTEGER NOT NULL, hash TEXT, FOREIGN KEY (cid) REFERENCES content(id) ON DELETE CASCADE, FOREIGN KEY (fid) REFERENCES function(id));
+CREATE TABLE hash (cid INTEGER, fid INTEGER NOT NULL, hash BLOB, FOREIGN KEY (cid) REFERENCES content(id) ON DELETE CASCADE, FOREIGN KEY (fid) REFERENCES function(id));
 CREATE TABLE dependency (pid INTEGER, required TEXT, FOREIGN KEY (pid) REFERENCES package(id) ON DELETE CASCADE);
 CREATE INDEX content_package_size_index ON content (pid, size);
 CREATE INDEX hash_cid_index ON hash (cid);
@@ -20,3 +20,14 @@ CREATE TABLE sharing (
 CREATE INDEX sharing_insert_index ON sharing (pid1, pid2, fid1, fid2);
 CREATE TABLE duplicate (cid INTEGER PRIMARY KEY, FOREIGN KEY (cid) REFERENCES content(id) ON DELETE CASCADE);
 CREATE TABLE issue (cid INTEGER REFERENCES content(id) ON DELETE CASCADE, issue TEXT);
+CREATE TABLE archive (sha256 BLOB PRIMARY KEY, pid INTEGER NOT NULL REFERENCES package(id) ON DELETE CASCADE);
+CREATE TABLE datamember (pid INTEGER PRIMARY KEY REFERENCES package(id) ON DELETE CASCADE, size INTEGER, mtime INTEGER);
+
+CREATE TABLE dirtypackage (pid INTEGER PRIMARY KEY REFERENCES package(id) ON DELETE CASCADE);
+CREATE TABLE dirtyhash (hash BLOB PRIMARY KEY);
+CREATE TRIGGER package_insert_trigger AFTER INSERT ON package BEGIN
+	INSERT INTO dirtypackage (pid) VALUES (NEW.id);
+END;
+CREATE TRIGGER package_delete_trigger BEFORE DELETE ON package BEGIN
+	INSERT OR IGNORE INTO dirtyhash (hash) SELECT hash.hash FROM hash JOIN content ON hash.cid = content.id WHERE content.pid = OLD.id;
+END;
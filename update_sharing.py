@@ -1,16 +1,122 @@
 #!/usr/bin/python
 
+import binascii
+import heapq
+import multiprocessing
+import optparse
+import os
 import sqlite3
+import struct
+import sys
+import tempfile
 
 from dedup.utils import fetchiter
 
-def add_values(cursor, insert_key, files, size):
-    cursor.execute("UPDATE sharing SET files = files + ?, size = size + ? WHERE pid1 = ? AND pid2 = ? AND fid1 = ? AND fid2 = ?;",
-                   (files, size) + insert_key)
-    if cursor.rowcount > 0:
-        return
-    cursor.execute("INSERT INTO sharing (pid1, pid2, fid1, fid2, files, size) VALUES (?, ?, ?, ?, ?, ?);",
-                   insert_key + (files, size))
+def hash_query(incremental, lower=False, upper=False):
+    """Build a query for the duplicated hashes to be processed.
+    @type incremental: bool
+    @param incremental: restrict to hashes touched since the last run
+    @type lower: bool
+    @param lower: whether the query takes a parameter for an inclusive lower
+        bound on the hash values
+    @type upper: bool
+    @param upper: whether the query takes a parameter for an exclusive upper
+        bound on the hash values
+    """
+    conditions = []
+    if incremental:
+        conditions.append("hash IN (SELECT hash FROM dirtyhash UNION SELECT hash.hash FROM hash JOIN content ON hash.cid = content.id JOIN dirtypackage ON content.pid = dirtypackage.pid)")
+    if lower:
+        conditions.append("hash >= ?")
+    if upper:
+        conditions.append("hash < ?")
+    where = ""
+    if conditions:
+        where = " WHERE " + " AND ".join(conditions)
+    return "SELECT hash FROM hash%s GROUP BY hash HAVING count(*) > 1;" % where
+
+class SharingAccumulator(object):
+    """Sum up files and size per (pid1, pid2, fid1, fid2) key in memory.
+    Once maxentries keys are held, they are written as a sorted run to a
+    temporary file. Iterating merges the runs with the remaining in-memory
+    entries."""
+    maxentries = 1024 * 1024
+    record = struct.Struct("<6q")
+
+    def __init__(self, maxentries=None):
+        """
+        @type maxentries: int or None
+        @param maxentries: number of keys to keep in memory before spilling
+        """
+        if maxentries is not None:
+            self.maxentries = maxentries
+        self.entries = dict()
+        self.runs = []
+
+    def add(self, key, files, size):
+        entry = self.entries.get(key)
+        if entry:
+            entry[0] += files
+            entry[1] += size
+            return
+        self.entries[key] = [files, size]
+        if len(self.entries) >= self.maxentries:
+            self.spill()
+
+    def spill(self):
+        run = tempfile.TemporaryFile()
+        for key, value in sorted(self.entries.items()):
+            run.write(self.record.pack(*(key + tuple(value))))
+        run.seek(0)
+        self.runs.append(run)
+        self.entries.clear()
+
+    def add_run(self, run):
+        """Merge a sorted run as written by save into this accumulator.
+        @param run: a file object positioned at the start of the run. It is
+            closed once consumed.
+        """
+        self.runs.append(run)
+
+    def save(self):
+        """Write all entries to a named temporary file as a single sorted run,
+        that can be passed to add_run in another process. The accumulator is
+        consumed in the process.
+        @returns: the name of the file
+        """
+        with tempfile.NamedTemporaryFile(delete=False) as run:
+            for row in self:
+                run.write(self.record.pack(*row))
+        return run.name
+
+    def iter_run(self, run):
+        data = run.read(self.record.size)
+        while data:
+            yield self.record.unpack(data)
+            data = run.read(self.record.size)
+        run.close()
+
+    def __iter__(self):
+        """Yield (pid1, pid2, fid1, fid2, files, size) tuples ordered by key.
+        Each key is yielded once. The accumulator is consumed in the process.
+        """
+        sources = [self.iter_run(run) for run in self.runs]
+        sources.append(key + tuple(value)
+                       for key, value in sorted(self.entries.items()))
+        self.runs = []
+        self.entries = dict()
+        current = None
+        for row in heapq.merge(*sources):
+            if current is None:
+                current = row
+            elif current[:4] == row[:4]:
+                current = current[:4] + (current[4] + row[4],
+                                         current[5] + row[5])
+            else:
+                yield current
+                current = row
+        if current is not None:
+            yield current
 
 def compute_pkgdict(rows):
     pkgdict = dict()
@@ -19,12 +125,19 @@ def compute_pkgdict(rows):
         funcdict.setdefault(fid, []).append((size, filename))
     return pkgdict
 
-def process_pkgdict(cursor, pkgdict):
+def process_pkgdict(accumulator, pkgdict, pids=None):
+    """
+    @type pids: set or None
+    @param pids: if given, only package pairs involving at least one of these
+        package ids are updated
+    """
     for pid1, funcdict1 in pkgdict.items():
         for fid1, files in funcdict1.items():
             numfiles = len(files)
             size = sum(entry[0] for entry in files)
             for pid2, funcdict2 in pkgdict.items():
+                if pids is not None and pid1 not in pids and pid2 not in pids:
+                    continue
                 if pid1 == pid2:
                     pkgnumfiles = numfiles - 1
                     pkgsize = size - min(entry[0] for entry in files)
@@ -34,31 +147,215 @@ def process_pkgdict(cursor, pkgdict):
                     pkgnumfiles = numfiles
                     pkgsize = size
                 for fid2 in funcdict2.keys():
-                    insert_key = (pid1, pid2, fid1, fid2)
-                    add_values(cursor, insert_key, pkgnumfiles, pkgsize)
+                    accumulator.add((pid1, pid2, fid1, fid2), pkgnumfiles,
+                                    pkgsize)
 
-def main():
-    db = sqlite3.connect("test.sqlite3")
-    cur = db.cursor()
-    cur.execute("PRAGMA foreign_keys = ON;")
-    cur.execute("DELETE FROM sharing;")
-    cur.execute("DELETE FROM duplicate;")
-    cur.execute("DELETE FROM issue;")
+def python_engine(db, hashquery, pids, accumulator, params=()):
+    """Compute the sharing of the hashes selected by hashquery one hash at a
+    time in Python.
+    @param pids: passed to process_pkgdict
+    @param params: parameters for hashquery
+    @type accumulator: SharingAccumulator
+    @returns: an iterator over the content ids of duplicated files. The
+        sharing is added to accumulator while the iterator is consumed.
+    """
     readcur = db.cursor()
-    readcur.execute("SELECT hash FROM hash GROUP BY hash HAVING count(*) > 1;")
+    readcur.execute(hashquery, params)
+    cur = db.cursor()
     for hashvalue, in fetchiter(readcur):
         cur.execute("SELECT content.pid, content.id, content.filename, content.size, hash.fid FROM hash JOIN content ON hash.cid = content.id WHERE hash = ?;",
                     (hashvalue,))
         rows = cur.fetchall()
-        print("processing hash %s with %d entries" % (hashvalue, len(rows)))
-        pkgdict = compute_pkgdict(rows)
+        print("processing hash %s with %d entries" %
+              (binascii.hexlify(hashvalue), len(rows)))
+        for row in rows:
+            yield row[1]
+        process_pkgdict(accumulator, compute_pkgdict(rows), pids)
+
+def sql_engine(cursor, hashquery, incremental):
+    """Prepare temporary tables for computing the sharing of the hashes
+    selected by hashquery with set-based SQL.
+    @type incremental: bool
+    @param incremental: whether to only consider package pairs involving a
+        package from the dirtypackage table
+    @returns: a pair of SELECT statements yielding the content ids of
+        duplicated files and the rows of the sharing table
+    """
+    cursor.execute("DROP TABLE IF EXISTS temp.duphash;")
+    cursor.execute("CREATE TEMP TABLE duphash (hash BLOB PRIMARY KEY);")
+    cursor.execute("INSERT INTO duphash (hash) %s" % hashquery)
+    cursor.execute("DROP TABLE IF EXISTS temp.hashpackage;")
+    cursor.execute("CREATE TEMP TABLE hashpackage AS SELECT hash.hash AS hash, content.pid AS pid, hash.fid AS fid, count(*) AS files, sum(content.size) AS size, min(content.size) AS minsize FROM duphash JOIN hash ON duphash.hash = hash.hash JOIN content ON hash.cid = content.id GROUP BY hash.hash, content.pid, hash.fid;")
+    cursor.execute("CREATE INDEX temp.hashpackage_hash_index ON hashpackage (hash);")
+    duplicatequery = "SELECT DISTINCT hash.cid FROM duphash JOIN hash ON duphash.hash = hash.hash;"
+    # Within one package a file does not share with itself, so one copy is
+    # not counted. This mirrors process_pkgdict.
+    pairfilter = ""
+    if incremental:
+        pairfilter = " AND (a.pid IN (SELECT pid FROM dirtypackage) OR b.pid IN (SELECT pid FROM dirtypackage))"
+    sharingquery = "SELECT a.pid, b.pid, a.fid, b.fid, sum(CASE WHEN a.pid = b.pid THEN a.files - 1 ELSE a.files END), sum(CASE WHEN a.pid = b.pid THEN a.size - a.minsize ELSE a.size END) FROM hashpackage AS a JOIN hashpackage AS b ON a.hash = b.hash WHERE (a.pid != b.pid OR a.files > 1)%s GROUP BY a.pid, b.pid, a.fid, b.fid;" % \
+            pairfilter
+    return duplicatequery, sharingquery
+
+def check_engines(db, hashquery, pids, incremental, maxentries=None):
+    """Run both engines on the same hashes without modifying the database and
+    report differences.
+    @returns: True if both engines agree
+    """
+    accumulator = SharingAccumulator(maxentries)
+    pyduplicates = set(python_engine(db, hashquery, pids, accumulator))
+    pysharing = set(accumulator)
+    cur = db.cursor()
+    duplicatequery, sharingquery = sql_engine(cur, hashquery, incremental)
+    cur.execute(duplicatequery)
+    sqlduplicates = set(row[0] for row in fetchiter(cur))
+    cur.execute(sharingquery)
+    sqlsharing = set(fetchiter(cur))
+    consistent = True
+    for what, pyset, sqlset in (("duplicate", pyduplicates, sqlduplicates),
+                                ("sharing", pysharing, sqlsharing)):
+        if pyset == sqlset:
+            print("%s: %d rows agree" % (what, len(pyset)))
+            continue
+        consistent = False
+        print("%s: %d rows only from python engine, %d rows only from sql engine" %
+              (what, len(pyset - sqlset), len(sqlset - pyset)))
+    return consistent
+
+def shard_bounds(shards):
+    """Split the hash space into ranges by the first two bytes of the hash.
+    @returns: a list of (lower, upper) pairs of bytes. None stands for an
+        open bound.
+    """
+    bounds = [None]
+    bounds.extend(struct.pack(">H", i * 0x10000 // shards)
+                  for i in range(1, shards))
+    bounds.append(None)
+    return zip(bounds[:-1], bounds[1:])
+
+def process_shard(args):
+    """Worker function for parallel_engine. It opens its own read-only
+    database connection and processes the duplicated hashes within the given
+    bounds.
+    @returns: a pair of the content ids of duplicated files and the name of a
+        file containing the sharing as a sorted run
+    """
+    incremental, pids, maxentries, (lower, upper) = args
+    db = sqlite3.connect("test.sqlite3")
+    db.execute("PRAGMA query_only = ON;")
+    params = tuple(sqlite3.Binary(bound) for bound in (lower, upper)
+                   if bound is not None)
+    hashquery = hash_query(incremental, lower is not None, upper is not None)
+    accumulator = SharingAccumulator(maxentries)
+    duplicates = list(python_engine(db, hashquery, pids, accumulator, params))
+    runname = accumulator.save()
+    db.close()
+    return duplicates, runname
+
+def parallel_engine(jobs, incremental, pids, maxentries=None):
+    """Run python_engine on shards of the hash space in jobs worker processes.
+    @returns: a pair of the content ids of duplicated files and a
+        SharingAccumulator merging the sharing of all shards
+    """
+    # Use more shards than workers, because duplicates are not evenly
+    # distributed across the hash space.
+    shards = [(incremental, pids, maxentries, bounds)
+              for bounds in shard_bounds(4 * jobs)]
+    duplicates = []
+    accumulator = SharingAccumulator(maxentries)
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for shardduplicates, runname in pool.imap_unordered(process_shard,
+                                                             shards):
+            duplicates.extend(shardduplicates)
+            accumulator.add_run(open(runname, "rb"))
+            os.unlink(runname)
+    finally:
+        pool.close()
+        pool.join()
+    return duplicates, accumulator
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("-i", "--incremental", action="store_true",
+                      help="only recompute hashes of packages imported or removed since the last run")
+    parser.add_option("-m", "--max-entries", action="store", type="int",
+                      help="number of sharing entries to aggregate in memory before spilling to disk")
+    parser.add_option("-e", "--engine", action="store", default="python",
+                      choices=("python", "sql"),
+                      help="compute the sharing hash by hash in python (default) or with set-based sql")
+    parser.add_option("-c", "--check", action="store_true",
+                      help="compare the results of both engines without modifying the database")
+    parser.add_option("-j", "--jobs", action="store", type="int", default=1,
+                      help="number of worker processes for the python engine")
+    options, args = parser.parse_args()
+    db = sqlite3.connect("test.sqlite3")
+    cur = db.cursor()
+    cur.execute("PRAGMA foreign_keys = ON;")
+    if options.incremental:
+        cur.execute("SELECT pid FROM dirtypackage;")
+        pids = set(row[0] for row in fetchiter(cur))
+        contentfilter = " AND content.pid IN (SELECT pid FROM dirtypackage)"
+    else:
+        pids = None
+        contentfilter = ""
+    hashquery = hash_query(options.incremental)
+    if options.check:
+        if not check_engines(db, hashquery, pids, options.incremental,
+                             options.max_entries):
+            sys.exit(1)
+        return
+    # autoimport.py -b drops this index during the import. Recreate it in
+    # case such an import was killed.
+    cur.execute("CREATE INDEX IF NOT EXISTS hash_hash_index ON hash (hash);")
+    if options.engine == "python" and options.jobs > 1:
+        # Run the workers before modifying the database, so they do not wait
+        # for our write lock.
+        duplicates, accumulator = parallel_engine(options.jobs,
+                                                  options.incremental, pids,
+                                                  options.max_entries)
+    elif options.engine == "sql":
+        # Prepare the temporary tables before modifying the database. On
+        # Python 2 their DDL statements would implicitly commit the deletions
+        # below and leave the tables empty if anything fails afterwards.
+        duplicatequery, sharingquery = sql_engine(cur, hashquery,
+                                                  options.incremental)
+    if options.incremental:
+        # Sharing rows of removed packages are gone due to ON DELETE CASCADE
+        # and rows between two unchanged packages stay valid.
+        cur.execute("DELETE FROM sharing WHERE pid1 IN (SELECT pid FROM dirtypackage) OR pid2 IN (SELECT pid FROM dirtypackage);")
+        cur.execute("DELETE FROM duplicate WHERE cid IN (SELECT hash.cid FROM hash JOIN dirtyhash ON hash.hash = dirtyhash.hash);")
+        cur.execute("DELETE FROM issue WHERE cid IN (SELECT content.id FROM content JOIN dirtypackage ON content.pid = dirtypackage.pid);")
+    else:
+        cur.execute("DELETE FROM sharing;")
+        cur.execute("DELETE FROM duplicate;")
+        cur.execute("DELETE FROM issue;")
+    if options.engine == "sql":
+        cur.execute("INSERT OR IGNORE INTO duplicate (cid) %s" %
+                    duplicatequery)
+        cur.execute("INSERT INTO sharing (pid1, pid2, fid1, fid2, files, size) %s" %
+                    sharingquery)
+    else:
+        if options.jobs <= 1:
+            accumulator = SharingAccumulator(options.max_entries)
+            duplicates = python_engine(db, hashquery, pids, accumulator)
         cur.executemany("INSERT OR IGNORE INTO duplicate (cid) VALUES (?);",
-                        [(row[1],) for row in rows])
-        process_pkgdict(cur, pkgdict)
-    cur.execute("INSERT INTO issue (cid, issue) SELECT content.id, 'file named something.gz is not a valid gzip file' FROM content WHERE content.filename LIKE '%.gz' AND NOT EXISTS (SELECT 1 FROM hash JOIN function ON hash.fid = function.id WHERE hash.cid = content.id AND function.name = 'gzip_sha512');")
-    cur.execute("INSERT INTO issue (cid, issue) SELECT content.id, 'png image not named something.png' FROM content JOIN hash ON content.id = hash.cid JOIN function ON hash.fid = function.id WHERE function.name = 'png_sha512' AND lower(filename) NOT LIKE '%.png';")
-    cur.execute("INSERT INTO issue (cid, issue) SELECT content.id, 'gif image not named something.gif' FROM content JOIN hash ON content.id = hash.cid JOIN function ON hash.fid = function.id WHERE function.name = 'gif_sha512' AND lower(filename) NOT LIKE '%.gif';")
+                        ((cid,) for cid in duplicates))
+        cur.executemany("INSERT INTO sharing (pid1, pid2, fid1, fid2, files, size) VALUES (?, ?, ?, ?, ?, ?);",
+                        accumulator)
+    cur.execute("INSERT INTO issue (cid, issue) SELECT content.id, 'file named something.gz is not a valid gzip file' FROM content WHERE content.filename LIKE '%%.gz' AND NOT EXISTS (SELECT 1 FROM hash JOIN function ON hash.fid = function.id WHERE hash.cid = content.id AND function.name = 'gzip_sha512')%s;" %
+                contentfilter)
+    cur.execute("INSERT INTO issue (cid, issue) SELECT content.id, 'png image not named something.png' FROM content JOIN hash ON content.id = hash.cid JOIN function ON hash.fid = function.id WHERE function.name = 'png_sha512' AND lower(filename) NOT LIKE '%%.png'%s;" %
+                contentfilter)
+    cur.execute("INSERT INTO issue (cid, issue) SELECT content.id, 'gif image not named something.gif' FROM content JOIN hash ON content.id = hash.cid JOIN function ON hash.fid = function.id WHERE function.name = 'gif_sha512' AND lower(filename) NOT LIKE '%%.gif'%s;" %
+                contentfilter)
+    cur.execute("DELETE FROM dirtypackage;")
+    cur.execute("DELETE FROM dirtyhash;")
     db.commit()
+    # The generation counter tells webapp.py to discard its cached pages.
+    cur.execute("PRAGMA user_version;")
+    generation = cur.fetchone()[0] + 1
+    cur.execute("PRAGMA user_version = %d;" % generation)
 
 if __name__ == "__main__":
     main()
@@ -1,15 +1,30 @@
 #!/usr/bin/python
 
+import binascii
 import datetime
+import hashlib
+import itertools
+import json
+import multiprocessing
+import optparse
+import os
+import Queue
+import shutil
+import SocketServer
 import sqlite3
-from wsgiref.simple_server import make_server
+import threading
+import time
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer
 
 import jinja2
-from werkzeug.exceptions import HTTPException, NotFound
+from werkzeug.exceptions import BadRequest, HTTPException, NotFound, \
+        ServiceUnavailable
 from werkzeug.routing import Map, Rule, RequestRedirect
 from werkzeug.wrappers import Request, Response
 from werkzeug.wsgi import SharedDataMiddleware
 
+import dedup
+from dedup.pagecache import PageCache
 from dedup.utils import fetchiter
 
 jinjaenv = jinja2.Environment(loader=jinja2.PackageLoader("dedup", "templates"))
@@ -53,30 +68,191 @@ def encode_and_buffer(iterator):
     if buff:
         yield buff
 
-def html_response(unicode_iterator, max_age=24 * 60 * 60):
-    resp = Response(encode_and_buffer(unicode_iterator), mimetype="text/html")
+def set_max_age(resp, max_age=24 * 60 * 60):
     resp.cache_control.max_age = max_age
     resp.expires = datetime.datetime.now() + datetime.timedelta(seconds=max_age)
     return resp
 
+def html_response(unicode_iterator, max_age=24 * 60 * 60):
+    resp = Response(encode_and_buffer(unicode_iterator), mimetype="text/html")
+    return set_max_age(resp, max_age)
+
+def json_dumps(obj):
+    return json.dumps(obj, separators=(",", ":"), sort_keys=True)
+
+def json_response(unicode_iterator, max_age=24 * 60 * 60):
+    resp = Response(encode_and_buffer(unicode_iterator),
+                    mimetype="application/json")
+    return set_max_age(resp, max_age)
+
+def parse_cursor(cursor, tiebreak):
+    """Parse a pagination cursor of the form size:tiebreak.
+    @type cursor: str or None
+    @param tiebreak: a function converting the part after the colon
+    @returns: None or a (size, tiebreak(...)) pair
+    @raises BadRequest: if the cursor is malformed
+    """
+    if cursor is None:
+        return None
+    try:
+        size, rest = cursor.split(":", 1)
+        return int(size), tiebreak(rest)
+    except (TypeError, ValueError):
+        raise BadRequest("invalid cursor")
+
+class ConnectionPool(object):
+    """A bounded pool of read-only connections to an SQLite database, that
+    can be shared between threads. Each connection must only be used by
+    one thread at a time."""
+    def __init__(self, filename, size):
+        """
+        @type filename: str
+        @type size: int
+        @param size: the number of connections
+        """
+        self.connections = Queue.Queue()
+        for _ in range(size):
+            self.connections.put(self.connect(filename))
+
+    @staticmethod
+    def connect(filename):
+        try:
+            db = sqlite3.connect("file:%s?mode=ro" % filename, uri=True,
+                                 check_same_thread=False)
+        except TypeError: # uri is not supported before Python 3.4
+            db = sqlite3.connect(filename, check_same_thread=False)
+        db.execute("PRAGMA query_only = ON;")
+        return db
+
+    def get(self):
+        """Wait for a connection to become available and return it."""
+        return self.connections.get()
+
+    def put(self, db):
+        """Return a connection obtained from get to the pool."""
+        self.connections.put(db)
+
 class Application(object):
-    def __init__(self, db):
-        self.db = db
+    # number of items returned by paginated api requests
+    page_size = 100
+    max_page_size = 1000
+
+    def __init__(self, db, cache=None, timeout=None, external=None):
+        """
+        @type db: sqlite3.Connection or ConnectionPool
+        @param db: a connection or a pool from which a connection is taken
+            for each request
+        @type cache: PageCache or None
+        @param cache: where to keep rendered pages until update_sharing.py
+            changes the database generation
+        @type timeout: int or None
+        @param timeout: number of seconds after which the queries of a
+            request are interrupted
+        @type external: dict or None
+        @param external: maps "compare" and "hash" to the base url of
+            another instance that links to those pages should point to,
+            e.g. because they are not exported
+        """
+        if isinstance(db, ConnectionPool):
+            self.pool = db
+            self.connection = None
+        else:
+            self.pool = None
+            self.connection = db
+        self.local = threading.local()
+        self.cache = cache
+        self.timeout = timeout
+        self.external = external or {}
         self.routingmap = Map([
             Rule("/", methods=("GET",), endpoint="index"),
             Rule("/binary/<package>", methods=("GET",), endpoint="package"),
             Rule("/compare/<package1>/<package2>", methods=("GET",), endpoint="detail"),
             Rule("/hash/<function>/<hashvalue>", methods=("GET",), endpoint="hash"),
             Rule("/source/<package>", methods=("GET",), endpoint="source"),
+            Rule("/api/binary/<package>", methods=("GET",), endpoint="api_package"),
+            Rule("/api/compare/<package1>/<package2>", methods=("GET",), endpoint="api_detail"),
+            Rule("/api/hash/<function>/<hashvalue>", methods=("GET",), endpoint="api_hash"),
+            Rule("/api/source/<package>", methods=("GET",), endpoint="api_source"),
         ])
 
+    @property
+    def db(self):
+        """The connection used by the request handled in the current
+        thread."""
+        if self.pool is None:
+            return self.connection
+        return self.local.db
+
     @Request.application
     def __call__(self, request):
+        if self.pool is None:
+            db = self.connection
+        else:
+            db = self.local.db = self.pool.get()
+        if self.timeout:
+            deadline = [time.time() + self.timeout]
+            db.set_progress_handler(lambda: time.time() > deadline[0], 1000)
+        def release():
+            if self.timeout:
+                db.set_progress_handler(None, 0)
+            if self.pool is not None:
+                del self.local.db
+                self.pool.put(db)
+        try:
+            resp = self.dispatch(request)
+        except sqlite3.OperationalError as exc:
+            release()
+            if "interrupted" in str(exc):
+                return ServiceUnavailable("request timed out")
+            raise
+        except:
+            release()
+            raise
+        if isinstance(resp, Response):
+            # Streamed responses still need the connection.
+            if self.timeout and resp.is_streamed:
+                resp.response = self.limit_chunks(resp.response, deadline,
+                                                  request)
+            resp.call_on_close(release)
+        else:
+            release()
+        return resp
+
+    def limit_chunks(self, iterable, deadline, request):
+        """Restart the timeout before computing each chunk of a streamed
+        response, so that the time spent sending earlier chunks to a slow
+        client does not count. If a query is interrupted anyway, the response
+        ends early, since the headers were already sent.
+        @type deadline: [float]
+        @param deadline: the single element is updated in place
+        """
+        iterator = iter(iterable)
+        try:
+            while True:
+                deadline[0] = time.time() + self.timeout
+                try:
+                    chunk = next(iterator)
+                except StopIteration:
+                    return
+                except sqlite3.OperationalError as exc:
+                    if "interrupted" not in str(exc):
+                        raise
+                    request.environ["wsgi.errors"].write(
+                        "%s: request timed out while streaming\n" %
+                        request.path)
+                    return
+                yield chunk
+        finally:
+            if hasattr(iterator, "close"):
+                iterator.close()
+
+    def dispatch(self, request):
         mapadapter = self.routingmap.bind_to_environ(request.environ)
         try:
             endpoint, args = mapadapter.match()
             if endpoint == "package":
-                return self.show_package(args["package"])
+                return self.cached_response(request, self.show_package,
+                                            args["package"])
             elif endpoint == "detail":
                 return self.show_detail(args["package1"], args["package2"])
             elif endpoint == "hash":
@@ -85,17 +261,56 @@ class Application(object):
                     raise RequestRedirect("%s/hash/png_sha512/%s" %
                                           (request.environ["SCRIPT_NAME"],
                                            args["hashvalue"]))
-                return self.show_hash(args["function"], args["hashvalue"])
+                return self.cached_response(request, self.show_hash,
+                                            args["function"],
+                                            args["hashvalue"])
             elif endpoint == "index":
                 if not request.environ["PATH_INFO"]:
                     raise RequestRedirect(request.environ["SCRIPT_NAME"] + "/")
                 return html_response(index_template.render(dict(urlroot="")))
             elif endpoint == "source":
-                return self.show_source(args["package"])
+                return self.cached_response(request, self.show_source,
+                                            args["package"])
+            elif endpoint == "api_package":
+                return self.api_package(args["package"])
+            elif endpoint == "api_detail":
+                return self.api_detail(request, args["package1"],
+                                       args["package2"])
+            elif endpoint == "api_hash":
+                return self.api_hash(request, args["function"],
+                                     args["hashvalue"])
+            elif endpoint == "api_source":
+                return self.api_source(args["package"])
             raise NotFound()
         except HTTPException as e:
             return e
 
+    def get_generation(self):
+        """
+        @returns: the generation counter, which update_sharing.py increments
+            in the user_version of the database
+        """
+        cur = self.db.cursor()
+        cur.execute("PRAGMA user_version;")
+        return cur.fetchone()[0]
+
+    def cached_response(self, request, func, *args):
+        """Return the page generated by func(*args) from the cache or store
+        it there. The response carries an ETag derived from the generation
+        and the page contents, so that clients can revalidate it cheaply.
+        """
+        generation = self.get_generation()
+        page = None
+        if self.cache:
+            page = self.cache.get(request.path, generation)
+        if page is None:
+            page = func(*args).get_data()
+            if self.cache:
+                self.cache.put(request.path, generation, page)
+        resp = set_max_age(Response(page, mimetype="text/html"))
+        resp.set_etag("%d-%s" % (generation, hashlib.sha1(page).hexdigest()))
+        return resp.make_conditional(request)
+
     def get_details(self, package):
         cur = self.db.cursor()
         cur.execute("SELECT id, version, architecture FROM package WHERE name = ?;",
@@ -135,61 +350,77 @@ class Application(object):
             curstats.append(dict(package=package2, duplicate=files, savable=size))
         return sharedstats
 
-    def show_package(self, package):
+    def get_package_params(self, package):
         params = self.get_details(package)
         params["dependencies"] = self.get_dependencies(params["pid"])
         params["shared"] = self.cached_sharedstats(params["pid"])
-        params["urlroot"] = ".."
         cur = self.db.cursor()
         cur.execute("SELECT content.filename, issue.issue FROM content JOIN issue ON content.id = issue.cid WHERE content.pid = ?;",
                     (params["pid"],))
         params["issues"] = dict(cur.fetchall())
         cur.close()
+        return params
+
+    def link_roots(self, urlroot):
+        """
+        @returns: a dict of the template parameters compareroot and hashroot
+            prefixing links to comparison and hash pages
+        """
+        return dict(compareroot=self.external.get("compare", urlroot),
+                    hashroot=self.external.get("hash", urlroot))
+
+    def show_package(self, package):
+        params = self.get_package_params(package)
+        params["urlroot"] = ".."
+        params.update(self.link_roots(".."))
         return html_response(package_template.render(params))
 
-    def compute_comparison(self, pid1, pid2):
+    def compute_comparison(self, pid1, pid2, after=None):
         """Compute a sequence of comparison objects ordery by the size of the
         object in the first package. Each element of the sequence is a dict
         defining the following keys:
          * filenames: A set of filenames in package 1 (pid1) all referring to
            the same object.
          * size: Size of the object in bytes.
+         * hash: The sha512 hash of the object as bytes.
          * matches: A mapping from filenames in package 2 (pid2) to a mapping
            from hash function pairs to hash values.
+        @type after: (int, bytes) or None
+        @param after: only compute objects ordered after the given size and
+            sha512 hash pair, i.e. smaller ones or equally sized ones with a
+            larger hash
         """
+        # Both queries are ordered by size and sha512 hash, so the matches
+        # can be merged into the files of package 1 without issuing a query
+        # per file. Matches are only looked up for one file per hash.
+        cond = ""
+        condargs = ()
+        if after is not None:
+            cond = " AND (content.size < ? OR (content.size = ? AND hash.hash > ?))"
+            condargs = (after[0], after[0], sqlite3.Binary(after[1]))
         cur = self.db.cursor()
-        cur.execute("SELECT content.id, content.filename, content.size, hash.hash FROM content JOIN hash ON content.id = hash.cid JOIN duplicate ON content.id = duplicate.cid JOIN function ON hash.fid = function.id WHERE pid = ? AND function.name = 'sha512' ORDER BY size DESC;",
-                    (pid1,))
-        cursize = -1
-        files = dict()
+        cur.execute("SELECT content.size, hash.hash, content.filename FROM content JOIN hash ON content.id = hash.cid JOIN duplicate ON content.id = duplicate.cid JOIN function ON hash.fid = function.id WHERE pid = ? AND function.name = 'sha512'%s ORDER BY size DESC, hash.hash;" % cond,
+                    (pid1,) + condargs)
+        cur2 = self.db.cursor()
+        cur2.execute("SELECT rep.size, rep.hash, fa.name, ha.hash, fb.name, content.filename FROM (SELECT min(content.id) AS cid, content.size AS size, hash.hash AS hash FROM content JOIN hash ON content.id = hash.cid JOIN duplicate ON content.id = duplicate.cid JOIN function ON hash.fid = function.id WHERE pid = ? AND function.name = 'sha512'%s GROUP BY content.size, hash.hash) AS rep JOIN hash AS ha ON rep.cid = ha.cid JOIN hash AS hb ON ha.hash = hb.hash JOIN content ON hb.cid = content.id JOIN function AS fa ON ha.fid = fa.id JOIN function AS fb ON hb.fid = fb.id WHERE content.pid = ? ORDER BY rep.size DESC, rep.hash;" % cond,
+                     (pid1,) + condargs + (pid2,))
+        # sqlite3 buffers are not hashable
+        groupkey = lambda row: (row[0], bytes(row[1]))
+        matches = itertools.groupby(fetchiter(cur2), groupkey)
+        matchkey, matchrows = next(matches, (None, None))
         minmatch = 2 if pid1 == pid2 else 1
-        for cid, filename, size, hashvalue in fetchiter(cur):
-            if cursize != size:
-                for entry in files.values():
-                    if len(entry["matches"]) >= minmatch:
-                        yield entry
-                files.clear()
-                cursize = size
-
-            if hashvalue in files:
-                files[hashvalue]["filenames"].add(filename)
-                continue
-
-            entry = dict(filenames=set((filename,)), size=size, matches={})
-            files[hashvalue] = entry
-
-            cur2 = self.db.cursor()
-            cur2.execute("SELECT fa.name, ha.hash, fb.name, filename FROM hash AS ha JOIN hash AS hb ON ha.hash = hb.hash JOIN content ON hb.cid = content.id JOIN function AS fa ON ha.fid = fa.id JOIN function AS fb ON hb.fid = fb.id WHERE ha.cid = ? AND pid = ?;",
-                         (cid, pid2))
-            for func1, hashvalue, func2, filename in fetchiter(cur2):
-                entry["matches"].setdefault(filename, {})[func1, func2] = \
-                        hashvalue
-            cur2.close()
-        cur.close()
-
-        for entry in files.values():
+        for key, rows in itertools.groupby(fetchiter(cur), groupkey):
+            entry = dict(filenames=set(row[2] for row in rows), size=key[0],
+                         hash=key[1], matches={})
+            if matchkey == key:
+                for _, _, func1, hashvalue, func2, filename in matchrows:
+                    entry["matches"].setdefault(filename, {})[func1, func2] = \
+                            binascii.hexlify(hashvalue)
+                matchkey, matchrows = next(matches, (None, None))
             if len(entry["matches"]) >= minmatch:
                 yield entry
+        cur.close()
+        cur2.close()
 
     def show_detail(self, package1, package2):
         details1 = details2 = self.get_details(package1)
@@ -202,22 +433,59 @@ class Application(object):
             details2=details2,
             urlroot="../..",
             shared=shared)
+        params.update(self.link_roots("../.."))
         return html_response(detail_template.stream(params))
 
-    def show_hash(self, function, hashvalue):
+    def get_hash_entries(self, function, hashvalue, after=None, limit=None):
+        """Look up the files having the given hash value under the given
+        hash function or an equivalent one ordered by size (descending) and
+        the rowid of the hash.
+        @type after: (int, int) or None
+        @param after: only return files ordered after the given size and
+            hash rowid pair
+        @type limit: int or None
+        @param limit: maximum number of files to return
+        @returns: a list of dicts with keys rowid, package, filename, size
+            and function
+        @raises NotFound: if the hash value is malformed or no files are
+            found
+        """
+        try:
+            digest = binascii.unhexlify(hashvalue)
+        except (TypeError, ValueError): # odd length or non-hex digits
+            raise NotFound()
+        cond = ""
+        args = (function, sqlite3.Binary(digest))
+        if after is not None:
+            cond = " AND (content.size < ? OR (content.size = ? AND hash.rowid > ?))"
+            args += (after[0], after[0], after[1])
+        query = "SELECT hash.rowid, package.name, content.filename, content.size, f2.name FROM hash JOIN content ON hash.cid = content.id JOIN package ON content.pid = package.id JOIN function AS f2 ON hash.fid = f2.id JOIN function AS f1 ON f2.eqclass = f1.eqclass WHERE f1.name = ? AND hash = ?%s ORDER BY content.size DESC, hash.rowid" % cond
+        if limit is not None:
+            query += " LIMIT ?"
+            args += (limit,)
         cur = self.db.cursor()
-        cur.execute("SELECT package.name, content.filename, content.size, f2.name FROM hash JOIN content ON hash.cid = content.id JOIN package ON content.pid = package.id JOIN function AS f2 ON hash.fid = f2.id JOIN function AS f1 ON f2.eqclass = f1.eqclass WHERE f1.name = ? AND hash = ?;",
-                    (function, hashvalue,))
-        entries = [dict(package=package, filename=filename, size=size,
-                        function=otherfunc)
-                   for package, filename, size, otherfunc in fetchiter(cur)]
-        if not entries:
+        cur.execute(query + ";", args)
+        entries = [dict(rowid=rowid, package=package, filename=filename,
+                        size=size, function=otherfunc)
+                   for rowid, package, filename, size, otherfunc
+                   in fetchiter(cur)]
+        if not entries and after is None:
             raise NotFound()
+        return entries
+
+    def show_hash(self, function, hashvalue):
+        entries = self.get_hash_entries(function, hashvalue)
         params = dict(function=function, hashvalue=hashvalue, entries=entries,
                       urlroot="../..")
         return html_response(hash_template.render(params))
 
-    def show_source(self, package):
+    def get_source_packages(self, package):
+        """
+        @returns: a dict mapping the binary packages built from the given
+            source package to None or a dict describing the package sharing
+            most with it, with keys package, funccomb, duplicate and savable
+        @raises NotFound: if the source package is unknown
+        """
         cur = self.db.cursor()
         cur.execute("SELECT name FROM package WHERE source = ?;",
                     (package,))
@@ -233,13 +501,300 @@ class Application(object):
             oldentry = binpkgs.get(binary)
             if not (oldentry and oldentry["savable"] >= size):
                 binpkgs[binary] = entry
+        return binpkgs
+
+    def show_source(self, package):
+        binpkgs = self.get_source_packages(package)
         params = dict(source=package, packages=binpkgs, urlroot="..")
+        params.update(self.link_roots(".."))
         return html_response(source_template.render(params))
 
+    def get_page_args(self, request):
+        """
+        @returns: the limit and cursor query arguments of a paginated api
+            request
+        @raises BadRequest: if the limit is not a positive number
+        """
+        try:
+            limit = int(request.args.get("limit", self.page_size))
+        except ValueError:
+            raise BadRequest("invalid limit")
+        if limit < 1:
+            raise BadRequest("invalid limit")
+        return min(limit, self.max_page_size), request.args.get("after")
+
+    def api_package(self, package):
+        params = self.get_package_params(package)
+        del params["pid"]
+        params["dependencies"] = sorted(params["dependencies"])
+        return json_response([json_dumps(params)])
+
+    def api_detail(self, request, package1, package2):
+        """Stream the objects of package1 shared with package2 as json. The
+        result is paginated by object size, the next field being the cursor
+        to pass as after for the next page or null on the last page."""
+        limit, cursor = self.get_page_args(request)
+        after = parse_cursor(cursor, binascii.unhexlify)
+        details1 = details2 = self.get_details(package1)
+        if package1 != package2:
+            details2 = self.get_details(package2)
+        shared = self.compute_comparison(details1["pid"], details2["pid"],
+                                         after)
+        def generate():
+            yield '{"package1":%s,"package2":%s,"shared":[' % \
+                    (json_dumps(package1), json_dumps(package2))
+            nextcursor = None
+            for num, entry in enumerate(shared):
+                if num == limit:
+                    nextcursor = "%d:%s" % (last["size"],
+                                            binascii.hexlify(last["hash"]))
+                    break
+                matches = [dict(filename=filename, function1=func1,
+                                function2=func2, hash=hashvalue)
+                           for filename, hashes in entry["matches"].items()
+                           for (func1, func2), hashvalue in hashes.items()]
+                matches.sort(key=lambda m: (m["filename"], m["function1"],
+                                            m["function2"]))
+                yield ("," if num else "") + json_dumps(dict(
+                    filenames=sorted(entry["filenames"]), size=entry["size"],
+                    hash=binascii.hexlify(entry["hash"]), matches=matches))
+                last = entry
+            shared.close()
+            yield '],"next":%s}' % json_dumps(nextcursor)
+        return json_response(generate())
+
+    def api_hash(self, request, function, hashvalue):
+        """Return the files with the given hash as json paginated like
+        api_detail."""
+        limit, cursor = self.get_page_args(request)
+        after = parse_cursor(cursor, int)
+        entries = self.get_hash_entries(function, hashvalue, after, limit + 1)
+        nextcursor = None
+        if len(entries) > limit:
+            del entries[limit:]
+            last = entries[-1]
+            nextcursor = "%d:%d" % (last["size"], last["rowid"])
+        for entry in entries:
+            del entry["rowid"]
+        result = dict(function=function, hash=hashvalue, entries=entries,
+                      next=nextcursor)
+        return json_response([json_dumps(result)])
+
+    def api_source(self, package):
+        result = dict(source=package,
+                      packages=self.get_source_packages(package))
+        return json_response([json_dumps(result)])
+
+class ThreadPoolWSGIServer(SocketServer.ThreadingMixIn, WSGIServer):
+    """A WSGIServer handling up to threads requests concurrently."""
+    daemon_threads = True
+    threads = 8
+
+    def __init__(self, server_address, handler_class, threads=None):
+        """
+        @type threads: int or None
+        @param threads: overrides the threads class attribute
+        """
+        WSGIServer.__init__(self, server_address, handler_class)
+        if threads is not None:
+            self.threads = threads
+        self.slots = threading.BoundedSemaphore(self.threads)
+
+    def process_request(self, request, client_address):
+        self.slots.acquire()
+        try:
+            SocketServer.ThreadingMixIn.process_request(self, request,
+                                                        client_address)
+        except:
+            self.slots.release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            SocketServer.ThreadingMixIn.process_request_thread(
+                self, request, client_address)
+        finally:
+            self.slots.release()
+
+def page_fingerprints(db, compare=False):
+    """Compute fingerprints of the data shown on the package and source pages
+    and optionally the comparison pages. A page only needs to be rendered
+    again when its fingerprint changes. Since a reimported package gets a new
+    id, the fingerprints are derived from the package ids and sharing rows.
+    @type db: sqlite3.Connection
+    @type compare: bool
+    @param compare: whether to include the comparison pages. Their number is
+        quadratic in the number of packages.
+    @returns: a dict mapping relative paths of pages to pairs of a
+        fingerprint and a triple of the Application method name and its
+        arguments rendering the page
+    """
+    cur = db.cursor()
+    cur.execute("SELECT id, name, version, source FROM package;")
+    packages = dict((pid, (name, version, source))
+                    for pid, name, version, source in fetchiter(cur))
+    # When several versions of a package are present, its pages show the
+    # one picked by Application.get_details.
+    pidsbyname = {}
+    for pid, (name, _, _) in packages.items():
+        pidsbyname.setdefault(name, []).append(pid)
+    shown = set()
+    for name, pids in pidsbyname.items():
+        if len(pids) > 1:
+            cur.execute("SELECT id, version, architecture FROM package WHERE name = ?;",
+                        (name,))
+            pids = [cur.fetchone()[0]]
+        shown.update(pids)
+    pkgdigests = dict((pid, hashlib.sha1(("%d %s %s" % (pid, name, version))
+                                         .encode("utf8")))
+                      for pid, (name, version, _) in packages.items())
+    pages = {}
+    cur.execute("SELECT pid1, pid2, fid1, fid2, files, size FROM sharing ORDER BY pid1, pid2;")
+    for (pid1, pid2), rows in itertools.groupby(fetchiter(cur),
+                                                lambda row: row[:2]):
+        rows = " ".join("%d %d %d %d" % row[2:] for row in rows)
+        pkgdigests[pid1].update(("%d %s\n" % (pid2, rows)).encode("ascii"))
+        if compare and pid1 in shown and pid2 in shown:
+            name1, name2 = packages[pid1][0], packages[pid2][0]
+            fingerprint = "%d %d %s" % (pid1, pid2, rows)
+            pages["compare/%s/%s" % (name1, name2)] = \
+                    (fingerprint, ("show_detail", (name1, name2)))
+    sources = {}
+    for pid, (name, _, source) in packages.items():
+        fingerprint = pkgdigests[pid].hexdigest()
+        if pid in shown:
+            pages["binary/%s" % name] = (fingerprint,
+                                         ("show_package", (name,)))
+        sources.setdefault(source, []).append(fingerprint)
+    for source, fingerprints in sources.items():
+        fingerprint = " ".join(sorted(fingerprints))
+        pages["source/%s" % source] = (fingerprint, ("show_source", (source,)))
+    return pages
+
+export_app = None
+export_dir = None
+
+def init_export_worker(dbname, directory, external):
+    global export_app, export_dir
+    export_app = Application(sqlite3.connect(dbname), external=external)
+    export_dir = directory
+
+def write_file(filename, data):
+    """Atomically replace the given file."""
+    dirname = os.path.dirname(filename)
+    if not os.path.isdir(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError: # created concurrently
+            pass
+    tmpname = "%s.%d.tmp" % (filename, os.getpid())
+    with open(tmpname, "wb") as outp:
+        outp.write(data)
+    os.rename(tmpname, filename)
+
+def export_page(item):
+    """Worker function for export.
+    @type item: (str, (str, tuple))
+    @param item: a path and how to render it as in page_fingerprints
+    @returns: the path or None if the page does not exist
+    """
+    path, (method, args) = item
+    try:
+        page = getattr(export_app, method)(*args).get_data()
+    except HTTPException:
+        return None
+    write_file(os.path.join(export_dir, path), page)
+    return path
+
+def export(dbname, directory, jobs, liveurl, compare=False):
+    """Render the package and source pages and optionally the comparison
+    pages into the given directory, so that any web server can serve them. A
+    manifest of the page fingerprints is kept in the directory and only pages
+    with changed fingerprints are rendered again.
+    @type liveurl: str
+    @param liveurl: the base url of a webapp.py instance, that links to hash
+        pages and comparison pages not exported point to
+    @type compare: bool
+    @param compare: whether to export the comparison pages
+    """
+    external = dict(hash=liveurl.rstrip("/"))
+    if not compare:
+        external["compare"] = external["hash"]
+    pages = page_fingerprints(sqlite3.connect(dbname), compare)
+    manifestname = os.path.join(directory, ".manifest")
+    manifest = {}
+    if os.path.exists(manifestname):
+        with open(manifestname) as inp:
+            manifest = dict(line.rstrip("\n").split("\t", 1) for line in inp)
+    for path in set(manifest) - set(pages):
+        print("removing %s" % path)
+        try:
+            os.unlink(os.path.join(directory, path))
+        except OSError:
+            pass
+    todo = [(path, page[1]) for path, page in pages.items()
+            if manifest.get(path) != page[0]]
+    print("rendering %d of %d pages" % (len(todo), len(pages)))
+    pool = multiprocessing.Pool(jobs, init_export_worker,
+                                (dbname, directory, external))
+    try:
+        for path in pool.imap_unordered(export_page, todo, 16):
+            if path is None:
+                continue
+            manifest[path] = pages[path][0]
+    finally:
+        pool.close()
+        pool.join()
+    params = dict((kind + "root", url) for kind, url in external.items())
+    params["urlroot"] = "."
+    write_file(os.path.join(directory, "index.html"),
+               index_template.render(params).encode("utf8"))
+    staticdir = os.path.join(os.path.dirname(dedup.__file__), "static")
+    for name in os.listdir(staticdir):
+        shutil.copy(os.path.join(staticdir, name), directory)
+    manifest = dict((path, fingerprint) for path, fingerprint in
+                    manifest.items() if path in pages)
+    write_file(manifestname, "".join("%s\t%s\n" % item
+                                      for item in sorted(manifest.items())))
+
 def main():
-    app = Application(sqlite3.connect("test.sqlite3"))
+    parser = optparse.OptionParser()
+    parser.add_option("--cache-size", action="store", type="int",
+                      default=PageCache.maxsize,
+                      help="number of bytes of rendered pages to keep in memory, 0 disables the cache")
+    parser.add_option("--cache-dir", action="store",
+                      help="additionally store rendered pages in the given directory")
+    parser.add_option("--export", action="store",
+                      help="render all package and source pages into the given directory instead of serving them")
+    parser.add_option("--export-compare", action="store_true",
+                      help="also export all comparison pages, which are quadratic in the number of packages")
+    parser.add_option("--live-url", action="store",
+                      help="base url of a running instance that exported pages link to for hash pages and pages not exported")
+    parser.add_option("-j", "--jobs", action="store", type="int",
+                      default=multiprocessing.cpu_count(),
+                      help="number of processes rendering pages for --export")
+    parser.add_option("-t", "--threads", action="store", type="int",
+                      default=ThreadPoolWSGIServer.threads,
+                      help="number of requests served concurrently")
+    parser.add_option("--timeout", action="store", type="int", default=60,
+                      help="interrupt requests whose queries take longer than the given number of seconds, 0 disables the timeout")
+    options, args = parser.parse_args()
+    if options.export:
+        if not options.live_url:
+            parser.error("--export requires --live-url")
+        export("test.sqlite3", options.export, options.jobs,
+               options.live_url, options.export_compare)
+        return
+    cache = None
+    if options.cache_size:
+        cache = PageCache(options.cache_size, options.cache_dir)
+    app = Application(ConnectionPool("test.sqlite3", options.threads), cache,
+                      options.timeout)
     app = SharedDataMiddleware(app, {"/": ("dedup", "static")})
-    make_server("0.0.0.0", 8800, app).serve_forever()
+    server = ThreadPoolWSGIServer(("0.0.0.0", 8800), WSGIRequestHandler,
+                                  options.threads)
+    server.set_app(app)
+    server.serve_forever()
 
 if __name__ == "__main__":
     main()